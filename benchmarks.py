@@ -0,0 +1,277 @@
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+import mysql.connector
+import pandas as pd
+import config_heliumplus
+
+
+def random_text(length):
+    return ''.join(random.choices(string.ascii_letters + string.digits + ' ', k=length))
+
+
+def generate_dump(path, tables=5, rows_per_insert=200, inserts_per_table=200):
+    """
+    Writes a synthetic mysqldump-style file with extended INSERT statements.
+
+    Returns:
+        int: Number of statements in the dump.
+    """
+    statements = 0
+    with open(path, 'w') as f:
+        for t in range(tables):
+            table = f'bench_table_{t}'
+            f.write(f"DROP TABLE IF EXISTS `{table}`;\n")
+            f.write(f"CREATE TABLE `{table}` (\n"
+                    "  `id` int NOT NULL,\n"
+                    "  `fname` varchar(64) DEFAULT NULL,\n"
+                    "  `address` varchar(255) DEFAULT NULL,\n"
+                    "  `amount` decimal(12,2) DEFAULT NULL,\n"
+                    "  `created_at` datetime DEFAULT NULL,\n"
+                    "  PRIMARY KEY (`id`)\n"
+                    ") ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;\n")
+            statements += 2
+            row_id = 0
+            for _ in range(inserts_per_table):
+                values = []
+                for _ in range(rows_per_insert):
+                    row_id += 1
+                    values.append(f"({row_id},'{random_text(12)}','{random_text(60)}',"
+                                  f"{random.uniform(0, 10000):.2f},'2024-01-01 10:00:00')")
+                f.write(f"INSERT INTO `{table}` VALUES {','.join(values)};\n")
+                statements += 1
+    return statements
+
+
+def benchmark_import(args):
+    """
+    Compares statements/sec of the per-statement import loop against bulk mode on a generated dump.
+    """
+    import import_heliumplus
+
+    host = 'localhost'
+    user = config_heliumplus.mysql_username
+    password = config_heliumplus.mysql_password
+    port = config_heliumplus.mysql_port
+    database = args.database
+
+    conn = mysql.connector.connect(host=host, user=user, password=password, port=port)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {database}")
+    cursor.close()
+    conn.close()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dump_path = os.path.join(tmp_dir, 'bench.sql')
+        statements = generate_dump(dump_path, args.tables, args.rows_per_insert, args.inserts_per_table)
+        print(f"Generated {statements} statements ({os.path.getsize(dump_path) / (1024 * 1024):.1f} MB)")
+
+        results = {}
+        for label, bulk in (('per-statement', False), ('bulk', True)):
+            stats = import_heliumplus.import_mysql_dump(host, user, password, database, port, dump_path, bulk=bulk)
+            results[label] = stats['statements'] / stats['seconds']
+            print(f"{label:<14} {stats['statements']} statements in {stats['seconds']:.2f}s "
+                  f"({results[label]:.0f} statements/s)")
+
+    print(f"Bulk speedup: {results['bulk'] / results['per-statement']:.1f}x")
+
+
+def benchmark_tokenize(args):
+    """
+    Measures the throughput of the dump tokenizer on a synthetic dump of roughly --size-mb.
+    """
+    from heliumplus_dump_parser import iter_sql_statements
+
+    with tempfile.TemporaryDirectory(dir=args.tmp_dir) as tmp_dir:
+        dump_path = os.path.join(tmp_dir, 'bench.sql')
+        inserts = max(1, args.size_mb * 1024 * 1024 // (200 * 100))
+        generate_dump(dump_path, tables=1, rows_per_insert=200, inserts_per_table=inserts)
+        size_mb = os.path.getsize(dump_path) / (1024 * 1024)
+        print(f"Generated {size_mb:.0f} MB dump")
+
+        start = time.monotonic()
+        statements = 0
+        with open(dump_path, 'r', buffering=1024 * 1024) as f:
+            for _ in iter_sql_statements(f):
+                statements += 1
+        seconds = time.monotonic() - start
+
+    print(f"Tokenized {statements} statements in {seconds:.1f}s "
+          f"({size_mb / seconds:.1f} MB/s, {statements / seconds:.0f} statements/s)")
+
+
+def create_wide_table(cursor, table, rows, int_columns=10, float_columns=10, datetime_columns=5, text_columns=15):
+    """
+    Creates a wide synthetic table of `rows` rows by repeatedly doubling a seed row set.
+    """
+    columns = ['`id` bigint NOT NULL AUTO_INCREMENT']
+    columns += [f'`int_{i}` int' for i in range(int_columns)]
+    columns += [f'`dec_{i}` decimal(12,2)' for i in range(float_columns)]
+    columns += [f'`dt_{i}` datetime' for i in range(datetime_columns)]
+    columns += [f'`txt_{i}` varchar(64)' for i in range(text_columns)]
+    cursor.execute(f"DROP TABLE IF EXISTS `{table}`")
+    cursor.execute(f"CREATE TABLE `{table}` ({', '.join(columns)}, PRIMARY KEY (`id`))")
+
+    names = ([f'int_{i}' for i in range(int_columns)] + [f'dec_{i}' for i in range(float_columns)]
+             + [f'dt_{i}' for i in range(datetime_columns)] + [f'txt_{i}' for i in range(text_columns)])
+    seed = []
+    for _ in range(1000):
+        seed.append(tuple([random.randint(0, 10 ** 6) for _ in range(int_columns)]
+                          + [round(random.uniform(0, 10 ** 4), 2) for _ in range(float_columns)]
+                          + ['2024-01-01 10:00:00' for _ in range(datetime_columns)]
+                          + [random_text(20) for _ in range(text_columns)]))
+    placeholders = ', '.join(['%s'] * len(names))
+    cursor.executemany(f"INSERT INTO `{table}` ({', '.join(names)}) VALUES ({placeholders})", seed)
+    count = len(seed)
+    while count < rows:
+        limit = min(count, rows - count)
+        cursor.execute(f"INSERT INTO `{table}` ({', '.join(names)}) "
+                       f"SELECT {', '.join(names)} FROM `{table}` LIMIT {limit}")
+        count += limit
+
+
+def cast_like_pandas_sync(df):
+    """
+    The per-column casts the pandas sync path applies (generate_bq_schema + map_pandas_dtypes).
+    """
+    for column in df.columns:
+        dtype = df[column].dtype
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            df[column] = df[column].astype('datetime64[ns]')
+        elif pd.api.types.is_integer_dtype(dtype):
+            df[column] = df[column].astype('Int64')
+        elif pd.api.types.is_float_dtype(dtype):
+            df[column] = df[column].astype('float64')
+        else:
+            df[column] = df[column].astype('object')
+    return df
+
+
+def benchmark_extract(args):
+    """
+    Compares pd.read_sql plus per-column casts against typed Arrow batches on a wide table.
+    """
+    from heliumplus_extract import iter_query_record_batches, peak_rss_mb
+
+    mysql_config = {
+        'user': config_heliumplus.mysql_username,
+        'password': config_heliumplus.mysql_password,
+        'host': 'localhost',
+        'port': config_heliumplus.mysql_port,
+    }
+    conn = mysql.connector.connect(**mysql_config)
+    cursor = conn.cursor()
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS {args.database}")
+    conn.database = args.database
+    if not args.reuse:
+        create_wide_table(cursor, 'bench_wide', args.rows)
+        conn.commit()
+    cursor.close()
+    conn.close()
+
+    mysql_config['database'] = args.database
+    query = 'SELECT * FROM bench_wide'
+
+    if args.path in ('pandas', 'both'):
+        start = time.monotonic()
+        conn = mysql.connector.connect(**mysql_config)
+        df = cast_like_pandas_sync(pd.read_sql(query, conn))
+        conn.close()
+        print(f"pandas: {len(df)} rows x {len(df.columns)} columns in {time.monotonic() - start:.1f}s, "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+        del df
+
+    if args.path in ('arrow', 'both'):
+        start = time.monotonic()
+        batches = list(iter_query_record_batches(mysql_config, query, args.chunk_size))
+        rows = sum(batch.num_rows for batch in batches)
+        print(f"arrow: {rows} rows x {batches[0].num_columns} columns in {time.monotonic() - start:.1f}s, "
+              f"peak RSS {peak_rss_mb():.0f} MB")
+
+
+def benchmark_encrypt(args):
+    """
+    Compares per-cell encrypt_data() against the column-at-a-time encrypt_values()
+    and the sharded encrypt_columns() with --workers.
+    """
+    from heliumplus_encryption import decrypt_data, detokenize, encrypt_columns, encrypt_data, encrypt_values
+
+    key = os.urandom(32)
+    values = [random_text(random.randint(3, args.max_length)) for _ in range(args.values)]
+
+    start = time.monotonic()
+    [encrypt_data(value, key) for value in values]
+    per_cell = time.monotonic() - start
+
+    start = time.monotonic()
+    encrypted = encrypt_values(values, key)
+    batch = time.monotonic() - start
+
+    start = time.monotonic()
+    sharded = encrypt_columns({'value': values}, key, workers=args.workers, shard_rows=args.shard_rows,
+                              deterministic=False)['value']
+    parallel = time.monotonic() - start
+
+    # Deterministic mode, with one value in ten repeated as with shared addresses
+    siv_key = os.urandom(64)
+    repeated = [values[i - i % 10] for i in range(len(values))] if args.repeated else values
+    start = time.monotonic()
+    tokens = encrypt_columns({'value': repeated}, siv_key, workers=args.workers, shard_rows=args.shard_rows,
+                             deterministic=True)['value']
+    deterministic = time.monotonic() - start
+
+    sample = random.sample(range(len(values)), min(1000, len(values)))
+    assert all(decrypt_data(encrypted[i], key) == values[i] for i in sample)
+    assert all(decrypt_data(sharded[i], key) == values[i] for i in sample)
+    assert all(detokenize(tokens[i], siv_key, 'value') == repeated[i] for i in sample)
+
+    print(f"per-cell: {len(values) / per_cell:.0f} values/s")
+    print(f"batch:    {len(values) / batch:.0f} values/s ({per_cell / batch:.1f}x)")
+    print(f"parallel: {len(values) / parallel:.0f} values/s ({per_cell / parallel:.1f}x, {args.workers} workers)")
+    print(f"deterministic: {len(values) / deterministic:.0f} values/s ({per_cell / deterministic:.1f}x)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Helium plus pipeline benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    import_parser = subparsers.add_parser('import', help='MySQL dump import statements/sec')
+    import_parser.add_argument('--database', default='heliumplus_benchmark')
+    import_parser.add_argument('--tables', type=int, default=5)
+    import_parser.add_argument('--rows-per-insert', type=int, default=200)
+    import_parser.add_argument('--inserts-per-table', type=int, default=200)
+    import_parser.set_defaults(func=benchmark_import)
+
+    tokenize_parser = subparsers.add_parser('tokenize', help='SQL dump tokenizer MB/sec')
+    tokenize_parser.add_argument('--size-mb', type=int, default=2048)
+    tokenize_parser.add_argument('--tmp-dir', default=None)
+    tokenize_parser.set_defaults(func=benchmark_tokenize)
+
+    extract_parser = subparsers.add_parser('extract', help='pandas vs Arrow extraction of a wide table')
+    extract_parser.add_argument('--database', default='heliumplus_benchmark')
+    extract_parser.add_argument('--rows', type=int, default=1000000)
+    extract_parser.add_argument('--chunk-size', type=int, default=100000)
+    extract_parser.add_argument('--path', choices=['pandas', 'arrow', 'both'], default='both',
+                                help='run one path per process to compare peak RSS')
+    extract_parser.add_argument('--reuse', action='store_true', help='reuse the table from a previous run')
+    extract_parser.set_defaults(func=benchmark_extract)
+
+    encrypt_parser = subparsers.add_parser('encrypt', help='per-cell vs batch column encryption')
+    encrypt_parser.add_argument('--values', type=int, default=500000)
+    encrypt_parser.add_argument('--max-length', type=int, default=60)
+    encrypt_parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    encrypt_parser.add_argument('--shard-rows', type=int, default=50000)
+    encrypt_parser.add_argument('--repeated', action='store_true',
+                                help='repeat each value ten times in the deterministic run')
+    encrypt_parser.set_defaults(func=benchmark_encrypt)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,17 @@ import os
 from pathlib import Path
 import paramiko
 import gzip
-import psycopg2
+import hashlib
+import json
 import config_heliumplus
 import datetime
+import queue
+import socket
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 # SFTP server connection details
 hostname = config_heliumplus.sftp_hostname
@@ -12,10 +20,279 @@ port = 22
 username = config_heliumplus.sftp_username
 password = config_heliumplus.sftp_password
 
-# Connect to SFTP server
-transport = paramiko.Transport((hostname, port))
-transport.connect(username=username, password=password)
-sftp = paramiko.SFTPClient.from_transport(transport)
+# Number of SFTP sessions used to download clinic dumps concurrently (1 = serial download)
+sftp_max_workers = getattr(config_heliumplus, 'sftp_max_workers', 4)
+
+# Number of times a dropped transfer is resumed before the clinic is marked as failed
+sftp_download_retries = getattr(config_heliumplus, 'sftp_download_retries', 3)
+
+# Number of times a failed SSH handshake is retried before a session cannot be opened
+sftp_connect_retries = getattr(config_heliumplus, 'sftp_connect_retries', 3)
+
+# Seconds to wait before the first connect retry, doubled for each following one
+sftp_retry_delay = getattr(config_heliumplus, 'sftp_retry_delay', 1.0)
+
+# Size of each read from the remote file
+sftp_chunk_size = 32768
+
+# Errors of the SSH connection that a reconnect can recover from. Not OSError as a
+# whole, so local disk errors (ENOSPC, EACCES) fail at once instead of reconnecting
+SFTP_TRANSIENT_ERRORS = (socket.timeout, ConnectionError, EOFError, paramiko.SSHException)
+
+# Number of dumps decompressed in parallel and the memory ceiling shared by their buffers
+unzip_max_workers = getattr(config_heliumplus, 'unzip_max_workers', os.cpu_count() or 1)
+unzip_memory_limit_mb = getattr(config_heliumplus, 'unzip_memory_limit_mb', 256)
+
+# Smallest read worth handing to a decompression worker
+unzip_min_chunk_size = 64 * 1024
+
+# Decompress dumps while they are downloaded and write them straight to dumps-sql/ (no dumps-gz/ copy)
+stream_decompress = getattr(config_heliumplus, 'stream_decompress', False)
+
+# Local record of the last dump imported and synced per clinic; dumps whose remote mtime
+# and size are unchanged are not downloaded again, so they are also not re-imported or re-synced
+dumps_manifest_path = getattr(config_heliumplus, 'dumps_manifest_path', 'dumps_manifest.json')
+skip_unchanged_dumps = getattr(config_heliumplus, 'skip_unchanged_dumps', True)
+
+# Entries of dumps downloaded but not yet imported and synced. They only move to the
+# manifest once the clinic's import and syncs succeeded, so a failed dump is fetched again
+dumps_pending_manifest_path = getattr(config_heliumplus, 'dumps_pending_manifest_path', 'dumps_manifest_pending.json')
+
+_manifest_lock = threading.Lock()
+
+
+def connect_sftp(hostname=hostname, port=port, username=username, password=password):
+    """
+    Opens a new SSH transport and SFTP session to the dumps server.
+
+    Returns:
+        tuple: (paramiko.Transport, paramiko.SFTPClient)
+    """
+    transport = paramiko.Transport((hostname, port))
+    transport.connect(username=username, password=password)
+    return transport, paramiko.SFTPClient.from_transport(transport)
+
+
+# Remote directory listings fetched during this run, keyed by folder path
+remote_listing_cache = {}
+
+# Number of SFTP requests issued during this run, by operation
+sftp_round_trips = Counter()
+sftp_round_trips_lock = threading.Lock()
+
+
+def count_round_trip(operation):
+    with sftp_round_trips_lock:
+        sftp_round_trips[operation] += 1
+
+
+def list_remote_dir(sftp, folder, use_cache=True):
+    """
+    Lists a remote folder with its file attributes in a single SFTP request.
+    Listings are cached for the run so a folder is never listed twice.
+
+    Returns:
+        list: paramiko.SFTPAttributes of the folder entries.
+    """
+    if use_cache and folder in remote_listing_cache:
+        return remote_listing_cache[folder]
+    count_round_trip('listdir_attr')
+    entries = sftp.listdir_attr(folder)
+    remote_listing_cache[folder] = entries
+    return entries
+
+
+def print_round_trips():
+    total = sum(sftp_round_trips.values())
+    details = ', '.join(f"{operation}={count}" for operation, count in sorted(sftp_round_trips.items()))
+    print(f"SFTP round trips: {total} ({details})")
+
+
+class SFTPSessionPool:
+    """
+    Bounded pool of SFTP sessions shared by the download workers.
+
+    Sessions are opened lazily up to `size`; a session that fails mid-transfer is
+    discarded so the next acquire opens a fresh connection. A failed handshake is
+    retried `retries` times with an exponential backoff.
+
+    Parameters:
+        size (int): Maximum number of open SFTP sessions.
+        connect (callable): Returns a (transport, sftp) tuple, defaults to connect_sftp.
+        retries (int): Connect attempts after the first one.
+        retry_delay (float): Seconds before the first retry.
+    """
+
+    def __init__(self, size, connect=connect_sftp, retries=sftp_connect_retries, retry_delay=sftp_retry_delay):
+        self.size = size
+        self._connect = connect
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._transports = {}
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        self._slots.acquire()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            session_transport, session = self._connect_with_retry()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._transports[id(session)] = session_transport
+        return session
+
+    def _connect_with_retry(self):
+        attempt = 0
+        while True:
+            try:
+                return self._connect()
+            except SFTP_TRANSIENT_ERRORS as e:
+                attempt += 1
+                if attempt > self._retries:
+                    raise
+                delay = self._retry_delay * 2 ** (attempt - 1)
+                print(f"SFTP connection failed ({e}), retrying in {delay:.0f}s (attempt {attempt}/{self._retries})")
+                time.sleep(delay)
+
+    def release(self, session):
+        self._idle.put(session)
+        self._slots.release()
+
+    def discard(self, session):
+        with self._lock:
+            session_transport = self._transports.pop(id(session), None)
+        for conn in (session, session_transport):
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+        self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                session_transport = self._transports.pop(id(session), None)
+            session.close()
+            if session_transport is not None:
+                session_transport.close()
+
+
+def load_manifest(path=dumps_manifest_path):
+    """
+    Loads the dumps manifest: {clinic: {file, st_mtime, st_size, checksum, downloaded_at}}.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path=dumps_manifest_path):
+    """
+    Writes the dumps manifest atomically so an interrupted run never leaves it truncated.
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def record_pending_entries(entries, pending_path=dumps_pending_manifest_path):
+    """
+    Adds the manifest entries of downloaded dumps to the pending manifest.
+    """
+    if not entries:
+        return
+    with _manifest_lock:
+        pending = load_manifest(pending_path)
+        pending.update(entries)
+        save_manifest(pending, pending_path)
+
+
+def confirm_manifest_entries(clinics, manifest_path=dumps_manifest_path, pending_path=dumps_pending_manifest_path):
+    """
+    Moves the pending entries of clinics whose dump was imported and synced into the
+    manifest, so their unchanged dumps are skipped from now on. Clinic names are
+    compared case-insensitively (folder names on the server, lower case in databasename.csv).
+    """
+    clinics = {clinic.lower() for clinic in clinics}
+    with _manifest_lock:
+        pending = load_manifest(pending_path)
+        confirmed = {clinic: entry for clinic, entry in pending.items() if clinic.lower() in clinics}
+        if not confirmed:
+            return
+        manifest = load_manifest(manifest_path)
+        manifest.update(confirmed)
+        save_manifest(manifest, manifest_path)
+        save_manifest({clinic: entry for clinic, entry in pending.items() if clinic not in confirmed}, pending_path)
+
+
+def discard_pending_entries(clinics, pending_path=dumps_pending_manifest_path):
+    """
+    Drops the pending entries of clinics whose import failed.
+    """
+    clinics = {clinic.lower() for clinic in clinics}
+    with _manifest_lock:
+        pending = load_manifest(pending_path)
+        kept = {clinic: entry for clinic, entry in pending.items() if clinic.lower() not in clinics}
+        if len(kept) != len(pending):
+            save_manifest(kept, pending_path)
+
+
+def is_dump_unchanged(manifest, clinic, file_name, st_mtime, st_size):
+    """
+    Returns True if the clinic's latest remote dump is the one already recorded in the manifest.
+    """
+    entry = manifest.get(clinic)
+    return (entry is not None
+            and entry['file'] == file_name
+            and entry['st_mtime'] == st_mtime
+            and entry['st_size'] == st_size)
+
+
+def manifest_entry(file_name, st_mtime, st_size, checksum):
+    return {
+        'file': file_name,
+        'st_mtime': st_mtime,
+        'st_size': st_size,
+        'checksum': checksum,
+        'downloaded_at': datetime.datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class HashingReader:
+    """
+    Read-only file wrapper that feeds every byte read into a hashlib digest.
+    """
+
+    def __init__(self, fileobj, digest):
+        self._fileobj = fileobj
+        self.digest = digest
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        self.digest.update(data)
+        return data
 
 
 def delete_all_files_in_folders(*folder_names):
@@ -28,6 +305,10 @@ def delete_all_files_in_folders(*folder_names):
     # Construct the full path for each folder and delete files within
     for folder_name in folder_names:
         local_dir = os.path.join(os.environ["PWD"],folder_name)
+
+        # dumps-gz/ is not created when dumps are streamed straight to dumps-sql/
+        if not os.path.isdir(local_dir):
+            continue
         
         # Delete each file in the folder
         for file_name in os.listdir(local_dir):
@@ -38,8 +319,289 @@ def delete_all_files_in_folders(*folder_names):
     print("All files deleted from the specified folders.")
 
 
+def find_latest_dump(sftp, folder, extension='.gz', days=7):
+    """
+    Finds the newest dump file in a remote clinic folder modified within the last `days` days.
+    Attributes come from one cached listdir_attr call instead of a stat per file.
+
+    Returns:
+        tuple: (file name, st_mtime, st_size), or (None, 0, 0) if no recent dump exists.
+    """
+    dump_files = [f for f in list_remote_dir(sftp, folder) if f.filename.endswith(extension)]
+    print([f.filename for f in dump_files])
+
+    window_start = (datetime.datetime.now() - datetime.timedelta(days=days)).timestamp()
+
+    latest_file = None
+    latest_time = 0
+    latest_size = 0
+    for file_attr in dump_files:
+        if file_attr.st_mtime > window_start and file_attr.st_mtime > latest_time:
+            latest_file = file_attr.filename
+            latest_time = file_attr.st_mtime
+            latest_size = file_attr.st_size
+
+    return latest_file, latest_time, latest_size
+
+
+def download_with_resume(pool, remote_path, local_path, retries=sftp_download_retries, remote_size=None):
+    """
+    Downloads a remote file, continuing from the bytes already on disk when the
+    connection drops instead of restarting the transfer.
+
+    Parameters:
+        pool (SFTPSessionPool): Pool to borrow SFTP sessions from.
+        remote_path (str): Path of the dump on the SFTP server.
+        local_path (str): Destination path; an existing partial file is resumed.
+        retries (int): Number of reconnect-and-resume attempts.
+        remote_size (int): Size from the folder listing; the file is stat'ed when omitted.
+
+    Returns:
+        int: Number of bytes transferred in this call.
+    """
+    transferred = 0
+    attempt = 0
+    while True:
+        session = pool.acquire()
+        try:
+            if remote_size is None:
+                count_round_trip('stat')
+                remote_size = session.stat(remote_path).st_size
+            offset = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+            if offset > remote_size:
+                # Local file is not a prefix of this remote file, start over
+                offset = 0
+
+            count_round_trip('open')
+            with session.open(remote_path, 'rb') as remote_file, \
+                    open(local_path, 'ab' if offset else 'wb') as local_file:
+                remote_file.seek(offset)
+                remote_file.prefetch(remote_size)
+                while offset < remote_size:
+                    data = remote_file.read(sftp_chunk_size)
+                    if not data:
+                        raise EOFError(f"Unexpected end of file at byte {offset} of {remote_path}")
+                    local_file.write(data)
+                    offset += len(data)
+                    transferred += len(data)
+
+            pool.release(session)
+            return transferred
+
+        except SFTP_TRANSIENT_ERRORS as e:
+            pool.discard(session)
+            attempt += 1
+            if attempt > retries:
+                raise
+            print(f"Transfer of {remote_path} interrupted ({e}), resuming at byte "
+                  f"{os.path.getsize(local_path) if os.path.exists(local_path) else 0} "
+                  f"(attempt {attempt}/{retries})")
+        except Exception:
+            pool.discard(session)
+            raise
+
+
+@contextmanager
+def open_remote_dump_stream(session, remote_path, digest=None):
+    """
+    Opens a remote gzip dump as a decompressed binary stream, so the dump is written
+    once to dumps-sql/ without a compressed copy in dumps-gz/.
+    If a hashlib digest is given, it is updated with the compressed bytes as they are read.
+    """
+    count_round_trip('open')
+    remote_file = session.open(remote_path, 'rb')
+    try:
+        remote_file.prefetch()
+        source = HashingReader(remote_file, digest) if digest is not None else remote_file
+        with gzip.GzipFile(fileobj=source, mode='rb') as stream:
+            yield stream
+    finally:
+        remote_file.close()
+
+
+def stream_to_sql_file(pool, remote_path, output_path, chunk_size=1024 * 1024,
+                       retries=sftp_download_retries):
+    """
+    Downloads a remote gzip dump and decompresses it on the fly into output_path.
+
+    The dump is written to a `.part` file and renamed when complete, so a partially
+    streamed dump is never picked up by the importer. A gzip stream cannot be
+    continued mid-member, so a dropped connection restarts the clinic's transfer.
+
+    Returns:
+        tuple: (decompressed bytes written, sha256 of the compressed remote file)
+    """
+    partial_path = output_path + '.part'
+    attempt = 0
+    while True:
+        session = pool.acquire()
+        try:
+            written = 0
+            digest = hashlib.sha256()
+            with open_remote_dump_stream(session, remote_path, digest) as stream, open(partial_path, 'wb') as f_out:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    f_out.write(chunk)
+                    written += len(chunk)
+            pool.release(session)
+            os.replace(partial_path, output_path)
+            return written, digest.hexdigest()
+
+        except SFTP_TRANSIENT_ERRORS as e:
+            pool.discard(session)
+            attempt += 1
+            if attempt > retries:
+                raise
+            print(f"Stream of {remote_path} interrupted ({e}), restarting (attempt {attempt}/{retries})")
+        except Exception:
+            pool.discard(session)
+            raise
+
+
+def download_clinic_dump(pool, folder, local_dir, stream=False, manifest=None):
+    """
+    Downloads the latest dump of one clinic folder and returns its transfer report.
+
+    With stream=True the dump is decompressed while it is downloaded and written to
+    `local_dir/<clinic>.sql` instead of `local_dir/<clinic>.tar.gz`. If a manifest is
+    given and the latest dump matches its entry, nothing is downloaded. The report
+    carries the new manifest entry under 'manifest'.
+    """
+    clinic = os.path.basename(folder)
+    report = {'clinic': clinic, 'file': None, 'bytes': 0, 'seconds': 0.0, 'status': 'no recent dump'}
+    start = time.monotonic()
+
+    session = pool.acquire()
+    try:
+        latest_file, latest_time, latest_size = find_latest_dump(session, folder)
+    except Exception:
+        pool.discard(session)
+        raise
+    pool.release(session)
+
+    if latest_file and manifest is not None and is_dump_unchanged(manifest, clinic, latest_file, latest_time, latest_size):
+        report['file'] = latest_file
+        report['status'] = 'unchanged'
+    elif latest_file:
+        remote_path = os.path.join(folder, latest_file)
+        report['file'] = latest_file
+        if stream:
+            local_path = os.path.join(local_dir, clinic.lower() + '.sql')
+            report['bytes'], checksum = stream_to_sql_file(pool, remote_path, local_path)
+            report['status'] = 'streamed'
+        else:
+            local_path = os.path.join(local_dir, clinic + '.tar.gz')
+            report['bytes'] = download_with_resume(pool, remote_path, local_path, remote_size=latest_size)
+            checksum = file_sha256(local_path)
+            report['status'] = 'downloaded'
+        report['manifest'] = manifest_entry(latest_file, latest_time, latest_size, checksum)
+
+    report['seconds'] = time.monotonic() - start
+    return report
+
+
+def print_download_report(reports):
+    """
+    Prints per-clinic duration and throughput of a download run.
+    """
+    print(f"{'clinic':<40} {'status':<16} {'MB':>10} {'seconds':>9} {'MB/s':>8}")
+    total_bytes = 0
+    for report in sorted(reports, key=lambda r: r['seconds'], reverse=True):
+        megabytes = report['bytes'] / (1024 * 1024)
+        rate = megabytes / report['seconds'] if report['seconds'] else 0.0
+        total_bytes += report['bytes']
+        print(f"{report['clinic']:<40} {report['status']:<16} {megabytes:>10.1f} {report['seconds']:>9.1f} {rate:>8.2f}")
+    print(f"Downloaded {total_bytes / (1024 * 1024):.1f} MB from {len(reports)} clinic folders.")
+
+
 ##################### Download heliumplus dumps from SFTP server ######################
+def heliumplus_dumps_download_parallel(max_workers=sftp_max_workers, connect=connect_sftp, stream=False,
+                                       skip_unchanged=skip_unchanged_dumps, manifest_path=dumps_manifest_path,
+                                       include=None, on_done=None, pending_path=dumps_pending_manifest_path,
+                                       raise_on_failure=True):
+    """
+    Downloads the latest dump of every clinic folder concurrently over a bounded
+    pool of SFTP sessions and prints a per-clinic throughput report.
+
+    Parameters:
+        max_workers (int): Number of concurrent SFTP sessions.
+        connect (callable): Returns a (transport, sftp) tuple, used to open pool sessions.
+        stream (bool): Decompress while downloading and write straight to dumps-sql/.
+        skip_unchanged (bool): Skip clinics whose latest dump matches the manifest.
+        manifest_path (str): Path of the dumps manifest, read to skip unchanged dumps.
+        pending_path (str): Path of the pending manifest the entries of downloaded dumps are added to.
+        include (callable): Called with each clinic folder name, only clinics it returns True for are downloaded.
+        on_done (callable): Called with each clinic's report, including failed ones, as it completes.
+        raise_on_failure (bool): Raise a RuntimeError naming the failed clinics once all are done;
+            otherwise they are only reported, e.g. to on_done.
+
+    Returns:
+        list: The clinic reports.
+    """
+    local_dir = os.path.join(os.environ["PWD"], "dumps-sql" if stream else "dumps-gz")
+    remote_dir = '/home/helium/heliumplus_weekly'
+
+    manifest = load_manifest(manifest_path)
+    downloaded = {}
+    pool = SFTPSessionPool(max_workers, connect=connect)
+    reports = []
+    failed = []
+    try:
+        session = pool.acquire()
+        try:
+            folder_dirs = [remote_dir + "/" + folder.filename for folder in list_remote_dir(session, remote_dir)
+                           if include is None or include(folder.filename)]
+        except Exception:
+            pool.discard(session)
+            raise
+        pool.release(session)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(download_clinic_dump, pool, folder, local_dir, stream,
+                                       manifest if skip_unchanged else None): folder
+                       for folder in folder_dirs}
+            for future in as_completed(futures):
+                folder = futures[future]
+                try:
+                    report = future.result()
+                except Exception as e:
+                    print(f"Error downloading {folder}: {e}")
+                    failed.append(folder)
+                    report = {'clinic': os.path.basename(folder), 'file': None, 'bytes': 0,
+                              'seconds': 0.0, 'status': 'failed'}
+                else:
+                    print(f"{report['clinic']}: {report['status']} {report['file'] or ''}")
+                    if 'manifest' in report:
+                        downloaded[report['clinic']] = report['manifest']
+                reports.append(report)
+                if on_done is not None:
+                    on_done(report)
+    finally:
+        pool.close()
+        record_pending_entries(downloaded, pending_path)
+
+    print_download_report(reports)
+    print_round_trips()
+
+    if failed and raise_on_failure:
+        raise RuntimeError(f"Failed to download dumps for: {', '.join(failed)}")
+    return reports
+
+
 def heliumplus_dumps_download():
+            # Connect to SFTP server
+            transport, sftp = connect_sftp()
+            try:
+                heliumplus_dumps_download_serial(sftp)
+            finally:
+                # Close SFTP connection
+                sftp.close()
+                transport.close()
+
+
+def heliumplus_dumps_download_serial(sftp):
             # Local directory to save downloaded files
             folder_name = "dumps-gz"
             local_dir = os.path.join(os.environ["PWD"], folder_name)
@@ -49,10 +611,12 @@ def heliumplus_dumps_download():
             extension = '.gz'
             folders = []
 
-            for folder in sftp.listdir_attr(remote_dir):
+            for folder in list_remote_dir(sftp, remote_dir):
                     folders.append("/home/helium/heliumplus_weekly/" + folder.filename)
                     folder_dirs = folders
 
+            manifest = load_manifest()
+
             # # remove invalid folder       
             # folder_dirs.remove('/home/helium/heliumplus/datastore/FertilAid_Clinic')
 
@@ -61,35 +625,14 @@ def heliumplus_dumps_download():
                 # folder = folder + "/backups"
                 print(folder)
 
-                # Get list of files with extension gz in folder directory
-                files = sftp.listdir(folder)
-                dump_files = [f for f in files if f.endswith(extension)]
-                print(dump_files)
-
-                # print(local_dir)
-
-                # remote_path = remote_dir
-                # local_path = os.path.join(local_dir, os.path.basename(folder) + '.tar.gz')
-                # sftp.get(remote_path, local_path)
-
-                # Calculate the timestamp for 7 days ago from the current time
-                current_time = datetime.datetime.now()
-                seven_days_ago = current_time - datetime.timedelta(days=7)
-                seven_days_ago_timestamp = seven_days_ago.timestamp()
-
-                # Find the latest file
-                latest_file = None
-                latest_time = 0
-                for file in dump_files:
-                    remote_path = os.path.join(folder, file)
-                    file_attr = sftp.stat(remote_path)
-                    file_time = file_attr.st_mtime
-                    # Check if the file's modification time is within the last 7 days
-                    if file_time > seven_days_ago_timestamp and file_time > latest_time:
-                    # if file_time > latest_time:
-                        latest_file =  file
-                        latest_time = file_time
-                        # print(latest_time)
+                # Find the latest file modified within the last 7 days
+                latest_file, latest_time, latest_size = find_latest_dump(sftp, folder, extension)
+
+                # Skip dumps already downloaded by a previous run
+                clinic = os.path.basename(folder)
+                if latest_file and skip_unchanged_dumps and is_dump_unchanged(manifest, clinic, latest_file, latest_time, latest_size):
+                    print(f"{clinic}: {latest_file} unchanged since last run, skipping")
+                    continue
 
                 # Download the latest file to local directory
                 if latest_file:
@@ -98,12 +641,66 @@ def heliumplus_dumps_download():
                     local_path = os.path.join(local_dir, os.path.basename(folder) + '.tar.gz')
                         
 
+                    count_round_trip('get')
                     sftp.get(remote_path, local_path)
 
+                    record_pending_entries({clinic: manifest_entry(latest_file, latest_time, latest_size,
+                                                                   file_sha256(local_path))})
+
+            print_round_trips()
+
+
+def decompress_dump(input_file, output_file, chunk_size):
+    """
+    Decompresses one gzip dump to disk in fixed-size chunks so memory use stays
+    constant regardless of the dump size. The dump is written to a `.part` file and
+    renamed when complete, so a failed decompression leaves no truncated dump behind.
+
+    Returns:
+        dict: File name, compressed and decompressed byte counts, seconds and MB/s.
+    """
+    start = time.monotonic()
+    written = 0
+    partial_file = output_file + '.part'
+    try:
+        with gzip.open(input_file, "rb") as f_in, open(partial_file, "wb") as f_out:
+            while True:
+                chunk = f_in.read(chunk_size)
+                if not chunk:
+                    break
+                f_out.write(chunk)
+                written += len(chunk)
+    except BaseException:
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
+        raise
+    os.replace(partial_file, output_file)
+
+    seconds = time.monotonic() - start
+    return {
+        'file': os.path.basename(input_file),
+        'compressed_bytes': os.path.getsize(input_file),
+        'bytes': written,
+        'seconds': seconds,
+        'mb_per_second': written / (1024 * 1024) / seconds if seconds else 0.0,
+    }
 
 
 ##################### Unzip dumps files ######################
-def unzip_dumps():
+def unzip_dumps(max_workers=unzip_max_workers, memory_limit_mb=unzip_memory_limit_mb, raise_on_failure=True):
+            """
+            Decompresses every dump in dumps-gz/ into dumps-sql/, several archives at
+            a time across a process pool. A dump that fails to decompress does not stop
+            the others.
+
+            Parameters:
+                max_workers (int): Number of dumps decompressed in parallel.
+                memory_limit_mb (int): Ceiling on the decompression buffers held by all workers together.
+                raise_on_failure (bool): Raise a RuntimeError naming the failed dumps once all are done.
+
+            Returns:
+                dict: {dump file name: error} of the dumps that could not be decompressed.
+            """
             # specify the directory path
             folder_name = "dumps-gz/"
             folder_path = os.path.join(os.environ["PWD"], folder_name)
@@ -115,23 +712,31 @@ def unzip_dumps():
             if '.DS_Store' in folder_names:
                 folder_names.remove('.DS_Store')
 
+            # split the memory ceiling between the workers, each holds one chunk at a time; fewer
+            # workers are started when their share would be below the minimum chunk size
+            memory_limit = memory_limit_mb * 1024 * 1024
+            max_workers = max(1, min(max_workers, len(folder_names) or 1, memory_limit // unzip_min_chunk_size))
+            chunk_size = max(1, min(memory_limit // max_workers, 16 * 1024 * 1024))
+
+            jobs = []
             for folder_name in folder_names:
                 input_file = folder_path + folder_name
                 output_file = input_file.replace(".tar.gz", ".sql").replace("-gz", "-sql")
+                jobs.append((input_file, output_file))
 
-            # open the input .gz file in binary mode
-                with gzip.open(input_file, "rb") as f_in:
-                    # open the output file in write mode
-                    with open(output_file, "wb") as f_out:
-                        # copy the contents of the .gz file to the output file
-                        f_out.write(f_in.read())
-
-                # create the new lowercase file name
-                lowercase_output_file = output_file.lower()
-        
-                # rename the file to lowercase
-                os.rename(output_file, output_file)
-                # os.rename(output_file, lowercase_output_file)
+            failed = {}
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(decompress_dump, input_file, output_file, chunk_size): input_file
+                           for input_file, output_file in jobs}
+                for future in futures:
+                    try:
+                        stats = future.result()
+                    except Exception as e:
+                        print(f"Error decompressing {futures[future]}: {e}")
+                        failed[os.path.basename(futures[future])] = repr(e)
+                        continue
+                    print(f"Decompressed {stats['file']}: {stats['bytes'] / (1024 * 1024):.1f} MB "
+                          f"in {stats['seconds']:.1f}s ({stats['mb_per_second']:.1f} MB/s)")
 
             folder_name = "dumps-sql/"
 
@@ -143,14 +748,19 @@ def unzip_dumps():
                     os.rename(old_path, new_path)
                     print(f"Renamed: {filename} -> {filename.lower()}")
 
+            if failed and raise_on_failure:
+                raise RuntimeError(f"Failed to decompress dumps: {', '.join(sorted(failed))}")
+            return failed
+
 
 # execute function
 if __name__ == "__main__":
     delete_all_files_in_folders('dumps-gz','dumps-sql')  # Replace with your actual folder name
-    heliumplus_dumps_download()
-    unzip_dumps()
-
-
-# Close SFTP connection
-sftp.close()
-transport.close()
+    if stream_decompress:
+        heliumplus_dumps_download_parallel(stream=True)
+    elif sftp_max_workers > 1:
+        heliumplus_dumps_download_parallel()
+        unzip_dumps()
+    else:
+        heliumplus_dumps_download()
+        unzip_dumps()
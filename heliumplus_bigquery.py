@@ -0,0 +1,172 @@
+import io
+import os
+import threading
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+
+# INFORMATION_SCHEMA.COLUMNS data types under the names SchemaField.field_type uses
+INFORMATION_SCHEMA_TYPES = {'INT64': 'INTEGER', 'FLOAT64': 'FLOAT', 'BOOL': 'BOOLEAN'}
+
+_metadata_caches = {}
+_metadata_caches_lock = threading.Lock()
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def bigquery_client(credentials_path=None):
+    """
+    The BigQuery client of the run, created from the service account key on first
+    use, so importing a sync script does not authenticate or open a connection.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            if credentials_path is None:
+                credentials_path = os.path.join(os.path.abspath(os.getcwd()), 'heliumhealth-1ce77f433fc7.json')
+            _client = bigquery.Client.from_service_account_json(credentials_path)
+        return _client
+
+
+def arrow_bq_schema(arrow_schema):
+    """
+    BigQuery schema for an Arrow schema, with the same type mapping as generate_bq_schema().
+    """
+    schema = []
+    for field in arrow_schema:
+        if pa.types.is_timestamp(field.type) or pa.types.is_date(field.type):
+            schema.append(bigquery.SchemaField(field.name, "DATETIME"))
+        elif pa.types.is_integer(field.type):
+            schema.append(bigquery.SchemaField(field.name, "INTEGER"))
+        elif pa.types.is_floating(field.type):
+            schema.append(bigquery.SchemaField(field.name, "FLOAT"))
+        else:
+            schema.append(bigquery.SchemaField(field.name, "STRING"))
+    return schema
+
+
+def load_arrow_table(client, data, table_id, schema, write_disposition=None):
+    """
+    Loads an Arrow table or record batch into BigQuery as Parquet, without going
+    through a pandas DataFrame.
+
+    Returns:
+        bigquery.LoadJob: The finished load job.
+    """
+    if isinstance(data, pa.RecordBatch):
+        data = pa.Table.from_batches([data])
+    buffer = io.BytesIO()
+    pq.write_table(data, buffer)
+    buffer.seek(0)
+
+    job_config = bigquery.LoadJobConfig(schema=schema, source_format=bigquery.SourceFormat.PARQUET)
+    if write_disposition is not None:
+        job_config.write_disposition = write_disposition
+    job = client.load_table_from_file(buffer, table_id, job_config=job_config)
+    job.result()
+    return job
+
+
+class TableMetadataCache:
+    """
+    Which tables exist in each dataset, and their schemas, fetched once per run: one
+    list_tables call per dataset for existence, and one INFORMATION_SCHEMA.COLUMNS query
+    per dataset for the schemas of all its tables, instead of a get_table per table.
+    Callers report the tables they create, alter or delete so the cache stays current;
+    update_table() goes through the cache and refreshes the table's entry.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.schemas = {}
+
+    # API calls are made outside the lock, so tables of other datasets are not held up;
+    # if two threads fetch the same dataset, the first result is kept
+
+    def _dataset_tables(self, dataset_id):
+        with self.lock:
+            if dataset_id in self.tables:
+                return self.tables[dataset_id]
+        try:
+            tables = {table.table_id for table in self.client.list_tables(dataset_id)}
+        except NotFound:
+            # Dataset not created yet
+            tables = set()
+        with self.lock:
+            return self.tables.setdefault(dataset_id, tables)
+
+    def _dataset_schemas(self, dataset_id):
+        with self.lock:
+            if dataset_id in self.schemas:
+                return self.schemas[dataset_id]
+        query = (f"SELECT table_name, column_name, data_type FROM `{dataset_id}.INFORMATION_SCHEMA.COLUMNS` "
+                 f"ORDER BY table_name, ordinal_position")
+        schemas = {}
+        for row in self.client.query(query).result():
+            field_type = INFORMATION_SCHEMA_TYPES.get(row['data_type'], row['data_type'])
+            schemas.setdefault(row['table_name'], []).append(bigquery.SchemaField(row['column_name'], field_type))
+        with self.lock:
+            return self.schemas.setdefault(dataset_id, schemas)
+
+    def exists(self, dataset_id, table_name):
+        return table_name in self._dataset_tables(dataset_id)
+
+    def schema(self, dataset_id, table_name):
+        """
+        Schema of an existing table, or None if it does not exist.
+        """
+        if not self.exists(dataset_id, table_name):
+            return None
+        schema = self._dataset_schemas(dataset_id).get(table_name)
+        if schema is None:
+            # Created after the dataset's schemas were read
+            schema = self.client.get_table(self.client.dataset(dataset_id).table(table_name)).schema
+            with self.lock:
+                self.schemas[dataset_id][table_name] = schema
+        return schema
+
+    def added(self, dataset_id, table_name, schema=None):
+        """Records a table created by this run; its schema is fetched on first use unless given."""
+        tables = self._dataset_tables(dataset_id)
+        with self.lock:
+            tables.add(table_name)
+            if dataset_id in self.schemas:
+                if schema is None:
+                    self.schemas[dataset_id].pop(table_name, None)
+                else:
+                    self.schemas[dataset_id][table_name] = list(schema)
+
+    def deleted(self, dataset_id, table_name):
+        tables = self._dataset_tables(dataset_id)
+        with self.lock:
+            tables.discard(table_name)
+            if dataset_id in self.schemas:
+                self.schemas[dataset_id].pop(table_name, None)
+
+    def changed(self, dataset_id, table_name):
+        """Records a table whose schema was changed outside update_table(), e.g. by a script."""
+        self.added(dataset_id, table_name)
+
+    def update_table(self, table, fields):
+        """
+        client.update_table(), keeping the cached schema of the table in step.
+        """
+        table = self.client.update_table(table, fields)
+        self.added(table.dataset_id, table.table_id, table.schema)
+        return table
+
+
+def table_metadata(client):
+    """
+    The TableMetadataCache of a client, shared by every table synced in this run.
+    """
+    with _metadata_caches_lock:
+        if client not in _metadata_caches:
+            _metadata_caches[client] = TableMetadataCache(client)
+        return _metadata_caches[client]
@@ -0,0 +1,100 @@
+import datetime
+import json
+import os
+import threading
+from collections import Counter
+
+import config_heliumplus
+
+
+# Units (download, import, sync) completed by the current run of heliumplus_driver.py
+checkpoints_path = getattr(config_heliumplus, 'checkpoints_path', 'pipeline_checkpoints.json')
+
+
+class CheckpointStore:
+    """
+    Local record of the units of a pipeline run: {stage: {unit: {status, at, ...}}}.
+
+    A unit is 'done', 'skipped' (nothing to do, e.g. an unchanged dump) or 'failed';
+    a unit that is not recorded, or failed, is pending. Every change is written to
+    disk atomically, so a crashed run leaves the checkpoints of all finished units.
+
+    The checkpoints belong to one run id; opening the store with another run id, or
+    with fresh=True, starts from an empty record.
+
+    Parameters:
+        path (str): JSON file of the checkpoints.
+        run_id (str): Identifies the run the checkpoints are resumed for.
+        fresh (bool): Ignore the checkpoints on disk.
+    """
+
+    def __init__(self, path=checkpoints_path, run_id='local', fresh=False):
+        self.path = path
+        self._lock = threading.Lock()
+        data = None
+        if not fresh and os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('run_id') != run_id:
+                print(f"Checkpoints in {path} are from run {data.get('run_id')}, starting run {run_id} fresh")
+                data = None
+        self.resumed = data is not None
+        if data is None:
+            data = {'run_id': run_id, 'started_at': datetime.datetime.now().isoformat(timespec='seconds'), 'units': {}}
+        self.data = data
+
+    def unit(self, stage, key):
+        with self._lock:
+            return self.data['units'].get(stage, {}).get(key)
+
+    def status(self, stage, key):
+        unit = self.unit(stage, key)
+        return unit['status'] if unit else 'pending'
+
+    def is_complete(self, stage, key):
+        return self.status(stage, key) in ('done', 'skipped')
+
+    def record(self, stage, key, status, **details):
+        with self._lock:
+            self.data['units'].setdefault(stage, {})[key] = {
+                'status': status, 'at': datetime.datetime.now().isoformat(timespec='seconds'), **details}
+            self._save()
+
+    def reset(self, stage, key):
+        """Makes a unit pending again, e.g. when its output is gone."""
+        with self._lock:
+            if self.data['units'].get(stage, {}).pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True, default=str)
+        os.replace(tmp_path, self.path)
+
+    def counts(self):
+        with self._lock:
+            return Counter((stage, unit['status']) for stage, units in self.data['units'].items()
+                           for unit in units.values())
+
+    def failed(self):
+        with self._lock:
+            return [(stage, key, unit.get('error')) for stage, units in self.data['units'].items()
+                    for key, unit in units.items() if unit['status'] == 'failed']
+
+    def print_summary(self, pending=None):
+        """
+        Prints the units of the run by stage and status, and the failed units.
+
+        Parameters:
+            pending (dict): Units still pending by stage, e.g. blocked by a failed dependency.
+        """
+        counts = self.counts()
+        for stage in sorted({stage for stage, _ in counts} | set(pending or {})):
+            statuses = ', '.join(f"{counts[(stage, status)]} {status}" for status in ('done', 'skipped', 'failed')
+                                 if counts[(stage, status)])
+            if pending and pending.get(stage):
+                statuses += f"{', ' if statuses else ''}{pending[stage]} pending"
+            print(f"Checkpoints {stage:<9} {statuses}")
+        for stage, key, error in self.failed():
+            print(f"  failed: {stage} {key}: {error}")
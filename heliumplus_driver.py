@@ -0,0 +1,264 @@
+import argparse
+import os
+import time
+from collections import Counter
+
+import mysql.connector
+import pandas as pd
+
+import config_heliumplus
+from download_heliumplus_dumps import (confirm_manifest_entries, delete_all_files_in_folders,
+                                       heliumplus_dumps_download_parallel, sftp_max_workers, stream_decompress,
+                                       unzip_dumps)
+from heliumplus_checkpoints import CheckpointStore, checkpoints_path
+from heliumplus_mysql_pool import mysql_connection
+from heliumplus_sync_to_bigquery_merge import read_table_list, sync_tables
+from import_heliumplus import run_imports
+
+
+def mysql_server_config():
+    return {
+        'host': 'localhost',
+        'user': config_heliumplus.mysql_username,
+        'password': config_heliumplus.mysql_password,
+        'port': config_heliumplus.mysql_port,
+    }
+
+
+def clinic_databases(database_csv):
+    """
+    {clinic folder name in lower case: database} from databasename.csv.
+    """
+    df = pd.read_csv(database_csv)
+    return dict(zip(df['filename'].str.lower(), df['databasename']))
+
+
+def dump_path(clinic):
+    """
+    dumps-sql/<clinic>.sql, written by the streamed download or by unzip_dumps().
+    """
+    return os.path.join(os.path.abspath(os.getcwd()), 'dumps-sql', f'{clinic}.sql')
+
+
+def database_imported(database):
+    """
+    True if the database has tables on the local MySQL server, so a checkpointed
+    import is only trusted while the server still holds it (not on a new runner).
+    """
+    try:
+        with mysql_connection(mysql_server_config()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s", (database,))
+            count = cursor.fetchone()[0]
+            cursor.close()
+    except mysql.connector.Error:
+        return False
+    return count > 0
+
+
+class PipelineDriver:
+    """
+    Runs download -> import -> sync as a DAG of units: one download per clinic, one
+    import per database and one sync per table, each recorded in a CheckpointStore.
+
+    On a rerun only the pending and failed syncs are run, and a clinic is only
+    downloaded and imported again if one of its tables still has to be synced and
+    its checkpointed output is gone (no dump file, or no tables in MySQL). Each stage
+    keeps its own bounded concurrency (SFTP sessions, import processes, table
+    scheduler), so the stages run one after the other on the units that are ready.
+
+    Parameters:
+        store (CheckpointStore): Checkpoints of the run.
+        clinics (dict): {clinic: database} of the clinics to sync.
+        tables (list): (database, table, watermark column) entries to sync.
+    """
+
+    def __init__(self, store, clinics, tables):
+        self.store = store
+        self.clinics = clinics
+        self.databases = {database: clinic for clinic, database in clinics.items()}
+        self.tables = [entry for entry in tables if entry[0] in self.databases]
+
+    def table_key(self, entry):
+        return f'{entry[0]}.{entry[1]}'
+
+    def pending_tables(self):
+        return [entry for entry in self.tables if not self.store.is_complete('sync', self.table_key(entry))]
+
+    def skip_clinic(self, clinic, reason):
+        """Records a clinic with nothing to sync this run, and every unit depending on it."""
+        database = self.clinics[clinic]
+        self.store.record('import', database, 'skipped', reason=reason)
+        for entry in self.tables:
+            if entry[0] == database and not self.store.is_complete('sync', self.table_key(entry)):
+                self.store.record('sync', self.table_key(entry), 'skipped', reason=reason)
+
+    def confirm_dump(self, database):
+        """
+        Moves the clinic's downloaded dump into the dumps manifest once it is imported
+        and every table of the database is synced, so it is skipped while unchanged.
+        """
+        clinic = self.databases[database]
+        if self.store.status('download', clinic) != 'done' or self.store.status('import', database) != 'done':
+            return
+        if all(self.store.is_complete('sync', self.table_key(entry)) for entry in self.tables if entry[0] == database):
+            confirm_manifest_entries([clinic])
+
+    def plan(self):
+        """
+        Walks the DAG back from the pending syncs.
+
+        Returns:
+            tuple: (set of databases to import, set of clinics to download)
+        """
+        to_import = set()
+        to_download = set()
+        for database in sorted({entry[0] for entry in self.pending_tables()}):
+            clinic = self.databases[database]
+            download = self.store.unit('download', clinic)
+            if download and download['status'] == 'skipped':
+                self.skip_clinic(clinic, download.get('reason'))
+                continue
+            if self.store.is_complete('import', database) and database_imported(database):
+                continue
+            self.store.reset('import', database)
+            to_import.add(database)
+            if not (self.store.is_complete('download', clinic) and os.path.exists(dump_path(clinic))):
+                self.store.reset('download', clinic)
+                to_download.add(clinic)
+        return to_import, to_download
+
+    def download(self, clinics):
+        def on_done(report):
+            clinic = report['clinic'].lower()
+            if clinic not in self.clinics:
+                return
+            if report['status'] == 'failed':
+                self.store.record('download', clinic, 'failed', error='download failed')
+            elif report['status'] in ('downloaded', 'streamed'):
+                self.store.record('download', clinic, 'done', file=report['file'], bytes=report['bytes'],
+                                  seconds=round(report['seconds'], 1))
+            else:
+                # Unchanged since the last run or no recent dump: nothing to import or sync
+                self.store.record('download', clinic, 'skipped', reason=report['status'], file=report['file'])
+                self.skip_clinic(clinic, report['status'])
+
+        try:
+            heliumplus_dumps_download_parallel(max_workers=max(1, sftp_max_workers), stream=stream_decompress,
+                                               include=lambda folder: folder.lower() in clinics, on_done=on_done,
+                                               raise_on_failure=False)
+        except Exception as e:
+            # Failed clinics are recorded by on_done, only the listing of the clinic folders fails here
+            print(f"Download stage failed: {e}")
+            for clinic in clinics:
+                if self.store.status('download', clinic) == 'pending':
+                    self.store.record('download', clinic, 'failed', error=repr(e))
+        if not stream_decompress:
+            self.decompress(clinics)
+
+        for clinic in clinics:
+            if self.store.status('download', clinic) == 'pending':
+                self.store.record('download', clinic, 'skipped', reason='no dump folder')
+                self.skip_clinic(clinic, 'no dump folder')
+
+    def decompress(self, clinics):
+        """
+        Unzips the downloaded dumps and records the clinics whose dump could not be
+        decompressed as failed, so the other clinics still go on to the import.
+        """
+        try:
+            errors = {name.replace('.tar.gz', '').lower(): error
+                      for name, error in unzip_dumps(raise_on_failure=False).items()}
+        except Exception as e:
+            print(f"Decompression failed: {e}")
+            errors = {clinic: repr(e) for clinic in clinics}
+        for clinic in clinics:
+            if self.store.status('download', clinic) == 'done' and not os.path.exists(dump_path(clinic)):
+                self.store.record('download', clinic, 'failed', error=errors.get(clinic, 'no decompressed dump'))
+
+    def import_databases(self, databases):
+        imports = [(database, dump_path(self.databases[database])) for database in sorted(databases)
+                   if self.store.status('download', self.databases[database]) == 'done'
+                   and os.path.exists(dump_path(self.databases[database]))]
+        if not imports:
+            return
+
+        def on_done(database, stats):
+            if stats is None:
+                self.store.record('import', database, 'failed', error='import failed')
+            else:
+                self.store.record('import', database, 'done', statements=stats['statements'],
+                                  errors=stats['errors'], seconds=round(stats['seconds'], 1))
+
+        config = mysql_server_config()
+        run_imports(imports, config['host'], config['user'], config['password'], config['port'], on_done=on_done)
+
+    def sync(self):
+        tables = [entry for entry in self.pending_tables() if self.store.status('import', entry[0]) == 'done']
+        if not tables:
+            return
+
+        def on_done(result):
+            key = f"{result['database']}.{result['table']}"
+            if result['status'] == 'ok':
+                self.store.record('sync', key, 'done', seconds=round(result['seconds'], 1))
+            else:
+                self.store.record('sync', key, 'failed', error=result['error'])
+            self.confirm_dump(result['database'])
+
+        sync_tables(tables, on_done=on_done)
+
+    def run(self):
+        """
+        Runs the units that are not complete and prints the run's checkpoints.
+
+        Returns:
+            bool: True if every unit is done or skipped.
+        """
+        to_import, to_download = self.plan()
+        print(f"{len(self.pending_tables())} of {len(self.tables)} tables to sync, "
+              f"{len(to_import)} databases to import, {len(to_download)} clinics to download")
+        if to_download:
+            self.download(to_download)
+        if to_import:
+            self.import_databases(to_import)
+        self.sync()
+        for database in self.databases:
+            self.confirm_dump(database)
+
+        pending = Counter()
+        for entry in self.tables:
+            if self.store.status('sync', self.table_key(entry)) == 'pending':
+                pending['sync'] += 1
+        for database in to_import:
+            if self.store.status('import', database) == 'pending':
+                pending['import'] += 1
+        self.store.print_summary(pending)
+        return not pending and not self.store.failed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download, import and sync the Helium plus dumps, resuming '
+                                                 'the units of the run that are not complete')
+    parser.add_argument('--run-id', default=os.environ.get('GITHUB_RUN_ID', 'local'),
+                        help='checkpoints of another run id are discarded (defaults to GITHUB_RUN_ID)')
+    parser.add_argument('--fresh', action='store_true', help='ignore the checkpoints of this run id')
+    parser.add_argument('--checkpoints', default=checkpoints_path)
+    parser.add_argument('--database-csv', default='databasename.csv')
+    parser.add_argument('--table-csv', default='tablename.csv')
+    args = parser.parse_args()
+
+    store = CheckpointStore(args.checkpoints, args.run_id, fresh=args.fresh)
+    if not store.resumed:
+        delete_all_files_in_folders('dumps-gz', 'dumps-sql')
+
+    start = time.monotonic()
+    driver = PipelineDriver(store, clinic_databases(args.database_csv), read_table_list(args.table_csv))
+    complete = driver.run()
+    print(f"Pipeline run {args.run_id} {'completed' if complete else 'incomplete'} in {time.monotonic() - start:.0f}s")
+    if not complete:
+        raise RuntimeError(f"Pipeline run {args.run_id} has failed or pending units, rerun to resume them")
+
+
+if __name__ == '__main__':
+    main()
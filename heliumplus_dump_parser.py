@@ -0,0 +1,162 @@
+import re
+
+
+# Compiled literal patterns, "unrolled" so a whole string is matched by one regex call
+SINGLE_QUOTED = re.compile(r"'[^'\\]*(?:\\.[^'\\]*)*'", re.S)
+DOUBLE_QUOTED = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+BACKTICK_QUOTED = re.compile(r'`[^`]*`')
+
+# Remainder of a literal that started on a previous line
+SINGLE_QUOTED_END = re.compile(r"[^'\\]*(?:\\.[^'\\]*)*'", re.S)
+DOUBLE_QUOTED_END = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+BACKTICK_QUOTED_END = re.compile(r'[^`]*`')
+
+LITERALS = {"'": SINGLE_QUOTED, '"': DOUBLE_QUOTED, '`': BACKTICK_QUOTED}
+LITERAL_ENDS = {"'": SINGLE_QUOTED_END, '"': DOUBLE_QUOTED_END, '`': BACKTICK_QUOTED_END}
+
+NORMAL = 0
+QUOTED = 1
+BLOCK_COMMENT = 2
+
+
+def special_tokens(delimiter):
+    """
+    Compiles the regexes used in the NORMAL state for a given delimiter.
+
+    Returns:
+        tuple: (skip, tokens) where `skip` matches a run of plain text and complete
+        single-quoted literals (the bulk of an extended INSERT) in one call, and
+        `tokens` finds the next character sequence that changes the tokenizer state.
+    """
+    skip = re.compile(r"""(?:[^'"`#/*\-""" + re.escape(delimiter[0]) + r"""]+|'[^'\\]*(?:\\.[^'\\]*)*')*""", re.S)
+    tokens = re.compile(r"""['"`#]|--|/\*|\*/|""" + re.escape(delimiter))
+    return skip, tokens
+
+
+def iter_sql_statements(file, delimiter=';'):
+    """
+    Yields the statements of a MySQL dump from a text stream.
+
+    The tokenizer understands single, double and backtick quoted literals
+    (including backslash escapes and literals spanning lines), `--`, `#` and
+    `/* */` comments, and `DELIMITER` commands. Comments are dropped, except
+    executable `/*! ... */` and hint `/*+ ... */` comments which MySQL runs.
+    Statements are accumulated as a list of slices joined once, so the cost is
+    linear in the size of the dump.
+
+    Parameters:
+        file: Iterable of lines, e.g. an open text file.
+        delimiter (str): Initial statement delimiter.
+
+    Yields:
+        str: Statement text without the trailing delimiter.
+    """
+    skip, tokens = special_tokens(delimiter)
+    parts = []
+    state = NORMAL
+    quote = None
+
+    for line in file:
+        pos = 0
+        seg_start = 0
+        length = len(line)
+
+        if state == NORMAL and line[:1] in 'Dd \t' and line.lstrip()[:10].upper() == 'DELIMITER ':
+            if not any(part.strip() for part in parts):
+                delimiter = line.lstrip()[10:].strip()
+                skip, tokens = special_tokens(delimiter)
+                parts = []
+                continue
+
+        while pos < length:
+            if state == QUOTED:
+                m = LITERAL_ENDS[quote].match(line, pos)
+                if m is None:
+                    pos = length
+                    break
+                pos = m.end()
+                state = NORMAL
+                continue
+
+            if state == BLOCK_COMMENT:
+                end = line.find('*/', pos)
+                if end == -1:
+                    pos = seg_start = length
+                    break
+                pos = seg_start = end + 2
+                state = NORMAL
+                continue
+
+            pos = skip.match(line, pos).end()
+            m = tokens.search(line, pos)
+            if m is None:
+                pos = length
+                break
+            token = m.group()
+            start = m.start()
+
+            if token in LITERALS:
+                literal = LITERALS[token].match(line, start)
+                if literal is not None:
+                    pos = literal.end()
+                else:
+                    quote = token
+                    state = QUOTED
+                    pos = start + 1
+            elif token == delimiter:
+                parts.append(line[seg_start:start])
+                statement = ''.join(parts).strip()
+                if statement:
+                    yield statement
+                parts = []
+                pos = seg_start = m.end()
+            elif token == '#' or (token == '--' and (start + 2 >= length or line[start + 2].isspace())):
+                # Line comment, keep the newline so tokens on either side stay separated
+                parts.append(line[seg_start:start])
+                parts.append('\n')
+                pos = seg_start = length
+            elif token == '/*':
+                if line.startswith(('/*!', '/*+'), start):
+                    pos = start + 3
+                else:
+                    parts.append(line[seg_start:start])
+                    parts.append(' ')
+                    pos = seg_start = start + 2
+                    state = BLOCK_COMMENT
+            else:
+                # End of an executable comment, or '--' not followed by whitespace (an operator)
+                pos = m.end()
+
+        if seg_start < length:
+            parts.append(line[seg_start:])
+
+    statement = ''.join(parts).strip()
+    if statement:
+        yield statement
+
+
+# Leading keywords of the statements mysqldump writes for a single table,
+# optionally wrapped in an executable comment (e.g. /*!40000 ALTER TABLE `x` DISABLE KEYS */)
+TABLE_STATEMENT = re.compile(
+    r'\s*(?:/\*!\d*\s*)?'
+    r'(DROP\s+TABLE(?:\s+IF\s+EXISTS)?|CREATE\s+TABLE(?:\s+IF\s+NOT\s+EXISTS)?|'
+    r'INSERT\s+(?:IGNORE\s+)?INTO|REPLACE\s+INTO|LOCK\s+TABLES|ALTER\s+TABLE)'
+    r'\s+`?([^`\s(,]+)`?',
+    re.I)
+UNLOCK_TABLES = re.compile(r'\s*UNLOCK\s+TABLES\b', re.I)
+
+
+def statement_table(statement):
+    """
+    Classifies a dump statement by the table it belongs to.
+
+    Returns:
+        tuple: (verb, table) where verb is one of DROP, CREATE, INSERT, REPLACE, LOCK,
+        ALTER or UNLOCK (table None), or (None, None) for statements not tied to a table.
+    """
+    m = TABLE_STATEMENT.match(statement, 0, 256)
+    if m is not None:
+        return m.group(1).split()[0].upper(), m.group(2)
+    if UNLOCK_TABLES.match(statement, 0, 64):
+        return 'UNLOCK', None
+    return None, None
@@ -0,0 +1,329 @@
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+import config_heliumplus
+from heliumplus_dump_parser import iter_sql_statements, statement_table
+from import_heliumplus import database_list_to_import, open_dump_file
+
+
+# Output folder of the per-table Parquet files, one sub-folder per database
+parquet_folder = getattr(config_heliumplus, 'parquet_folder', 'dumps-parquet')
+
+# Rows buffered per table before a record batch is written
+parquet_batch_rows = getattr(config_heliumplus, 'parquet_batch_rows', 50000)
+
+# Number of dumps converted at the same time
+parquet_max_workers = getattr(config_heliumplus, 'parquet_max_workers', os.cpu_count() or 1)
+
+# A column of a CREATE TABLE: name, type and its arguments, e.g. enum('a)','b,c'), whose
+# quoted values may hold ')' and ',' like the quoted strings of VALUE below
+COLUMN_DEFINITION = re.compile(
+    r"""^\s*`((?:[^`]|``)+)`\s+([a-zA-Z]\w*)"""
+    r"""(\((?:'[^'\\]*(?:(?:\\.|'')[^'\\]*)*'|[^)'])*\))?(\s+unsigned)?""",
+    re.I | re.S)
+
+# One value of a VALUES tuple, followed by the ',' or ')' that ends it
+VALUE = re.compile(
+    r"""\s*(?:'([^'\\]*(?:(?:\\.|'')[^'\\]*)*)'"""              # 1: quoted string
+    r"""|_binary\s*'([^'\\]*(?:(?:\\.|'')[^'\\]*)*)'"""         # 2: binary string
+    r"""|0x([0-9A-Fa-f]*)"""                                    # 3: hex literal
+    r"""|b'([01]*)'"""                                          # 4: bit literal
+    r"""|(NULL)"""                                              # 5: NULL
+    r"""|([^,)\s]+))\s*([,)])""",                               # 6: number or other bare literal, 7: terminator
+    re.S | re.I)
+ROW_START = re.compile(r'\s*,?\s*\(')
+INSERT_HEADER = re.compile(r'\s*(?:INSERT|REPLACE)\s+(?:IGNORE\s+)?INTO\s+`?[^`\s(]+`?\s*(\(([^)]*)\))?\s*VALUES\s*', re.I)
+
+ESCAPES = {'0': '\0', 'b': '\b', 'n': '\n', 'r': '\r', 't': '\t', 'Z': '\x1a'}
+ESCAPE = re.compile(r"\\(.)|''", re.S)
+
+INTEGER_TYPES = {'tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'year', 'bit'}
+FLOAT_TYPES = {'float', 'double', 'real', 'decimal', 'numeric'}
+DATETIME_TYPES = {'datetime', 'timestamp', 'date'}
+
+
+def unescape(value):
+    return ESCAPE.sub(lambda m: "'" if m.group(1) is None else ESCAPES.get(m.group(1), m.group(1)), value)
+
+
+def arrow_type(mysql_type):
+    """
+    Maps a MySQL column type to the Arrow type written to Parquet. DECIMAL becomes
+    float64, as pd.read_sql() in extract_data_from_mysql() loads Decimal values as floats.
+    """
+    mysql_type = mysql_type.lower()
+    if mysql_type in INTEGER_TYPES:
+        return pa.int64()
+    if mysql_type in FLOAT_TYPES:
+        return pa.float64()
+    if mysql_type in DATETIME_TYPES:
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def parse_create_table(statement):
+    """
+    Reads the column names and types of a CREATE TABLE statement. A column line that
+    cannot be parsed raises ValueError rather than being left out of the schema, which
+    would shift the values of INSERTs without a column list onto the wrong columns.
+
+    Returns:
+        pa.Schema: Arrow schema of the table.
+    """
+    fields = []
+    for line in statement.splitlines()[1:]:
+        if not line.lstrip().startswith('`'):
+            # Keys, constraints and the closing line
+            continue
+        m = COLUMN_DEFINITION.match(line)
+        if m is None:
+            raise ValueError(f"Cannot parse column definition: {line.strip()!r}")
+        fields.append(pa.field(m.group(1).replace('``', '`'), arrow_type(m.group(2))))
+    return pa.schema(fields)
+
+
+def iter_insert_rows(statement):
+    """
+    Yields (column names or None, row values) for every tuple of an INSERT statement.
+    Values are str, bytes or None; conversion to the column type happens in TableWriter.
+    """
+    header = INSERT_HEADER.match(statement)
+    if header is None:
+        return
+    columns = [c.strip().strip('`') for c in header.group(2).split(',')] if header.group(1) else None
+    pos = header.end()
+    length = len(statement)
+    while pos < length:
+        start = ROW_START.match(statement, pos)
+        if start is None:
+            break
+        pos = start.end()
+        row = []
+        while True:
+            m = VALUE.match(statement, pos)
+            if m is None:
+                raise ValueError(f"Cannot parse INSERT values at offset {pos}: {statement[pos:pos + 80]!r}")
+            pos = m.end()
+            if m.group(1) is not None:
+                row.append(unescape(m.group(1)))
+            elif m.group(2) is not None:
+                row.append(unescape(m.group(2)).encode('utf-8'))
+            elif m.group(3) is not None:
+                row.append(bytes.fromhex(m.group(3)))
+            elif m.group(4) is not None:
+                row.append(str(int(m.group(4) or '0', 2)))
+            elif m.group(5) is not None:
+                row.append(None)
+            else:
+                row.append(m.group(6))
+            if m.group(7) == ')':
+                break
+        yield columns, row
+
+
+def convert_value(value, field_type):
+    if value is None:
+        return None
+    if pa.types.is_timestamp(field_type):
+        if isinstance(value, bytes) or value.startswith('0000-00-00'):
+            return None
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if isinstance(value, bytes):
+        if pa.types.is_integer(field_type):
+            return int.from_bytes(value, 'big')
+        return value.decode('utf-8', errors='replace')
+    if pa.types.is_integer(field_type):
+        return int(value)
+    if pa.types.is_floating(field_type):
+        return float(value)
+    return value
+
+
+class TableWriter:
+    """
+    Buffers the rows of one table column by column and writes them to Parquet in record batches.
+    """
+
+    def __init__(self, path, schema, batch_rows=parquet_batch_rows):
+        self.path = path
+        self.schema = schema
+        self.batch_rows = batch_rows
+        self.index = {field.name: i for i, field in enumerate(schema)}
+        self.columns = [[] for _ in schema]
+        self.rows = 0
+        self.written = 0
+        self.writer = pq.ParquetWriter(path, schema)
+
+    def append(self, columns, row):
+        expected = len(self.columns) if columns is None else len(columns)
+        if len(row) != expected:
+            raise ValueError(f"{os.path.basename(self.path)}: INSERT tuple has {len(row)} values "
+                             f"for {expected} columns")
+        if columns is None:
+            for values, value in zip(self.columns, row):
+                values.append(value)
+        else:
+            positions = {self.index[name]: value for name, value in zip(columns, row) if name in self.index}
+            for i, values in enumerate(self.columns):
+                values.append(positions.get(i))
+        self.rows += 1
+        if self.rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        arrays = [pa.array([convert_value(v, field.type) for v in values], type=field.type)
+                  for field, values in zip(self.schema, self.columns)]
+        self.writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=self.schema))
+        self.written += self.rows
+        self.columns = [[] for _ in self.schema]
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def convert_dump_to_parquet(dump_file_path, database_name, output_folder=parquet_folder):
+    """
+    Converts a MySQL dump into one Parquet file per table without loading it into MySQL.
+
+    The schema of each table comes from its CREATE TABLE statement and the rows from
+    its INSERT statements. Files are written to `output_folder/database_name/<table>.parquet`.
+
+    Returns:
+        dict: {table: rows written}
+    """
+    start = time.monotonic()
+    database_dir = os.path.join(output_folder, database_name)
+    os.makedirs(database_dir, exist_ok=True)
+
+    schemas = {}
+    writers = {}
+    current = None
+    try:
+        with open_dump_file(dump_file_path) as file:
+            for statement in iter_sql_statements(file):
+                verb, table = statement_table(statement)
+                if verb == 'CREATE':
+                    schemas[table] = parse_create_table(statement)
+                    if table in writers:
+                        # Table re-created later in the dump, start it over
+                        if current is writers[table]:
+                            current = None
+                        writers.pop(table).close()
+                    writers[table] = TableWriter(os.path.join(database_dir, f'{table}.parquet'), schemas[table])
+                elif verb in ('INSERT', 'REPLACE') and table in writers:
+                    if current is not None and current is not writers[table]:
+                        current.flush()
+                    current = writers[table]
+                    for columns, row in iter_insert_rows(statement):
+                        current.append(columns, row)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    rows = {table: writer.written for table, writer in writers.items()}
+    print(f"Converted {database_name}: {len(rows)} tables, {sum(rows.values())} rows "
+          f"in {time.monotonic() - start:.1f}s")
+    return rows
+
+
+def watermark_filter(schema, watermark):
+    """
+    Arrow filter keeping the rows from a (column, value) watermark on, the Parquet
+    counterpart of the `WHERE column >= value` used on MySQL. `value` is the string
+    stored in the watermarks file and is cast to the column type.
+    """
+    column, value = watermark
+    return pc.field(column) >= pa.scalar(value).cast(schema.field(column).type)
+
+
+def read_table_parquet(database_name, table_name, output_folder=parquet_folder, watermark=None):
+    """
+    Reads a converted table as a DataFrame with nullable integer columns, in the
+    shape the BigQuery loaders expect from extract_data_from_mysql().
+    Returns an empty DataFrame if the table was not in the dump.
+    """
+    path = os.path.join(output_folder, database_name, f'{table_name}.parquet')
+    if not os.path.exists(path):
+        print(f"Table {table_name} does not exist in {output_folder}/{database_name}. Skipping this table.")
+        return pd.DataFrame()
+    filters = watermark_filter(pq.read_schema(path), watermark) if watermark else None
+    return pq.read_table(path, filters=filters).to_pandas(types_mapper={pa.int64(): pd.Int64Dtype()}.get)
+
+
+def iter_table_parquet_chunks(database_name, table_name, chunk_size, output_folder=parquet_folder, watermark=None):
+    """
+    Streams a converted table as DataFrames of at most `chunk_size` rows, the Parquet
+    counterpart of heliumplus_extract.iter_query_chunks(). Yields nothing if the table
+    was not in the dump, and one empty DataFrame for an empty table.
+    """
+    path = os.path.join(output_folder, database_name, f'{table_name}.parquet')
+    if not os.path.exists(path):
+        print(f"Table {table_name} does not exist in {output_folder}/{database_name}. Skipping this table.")
+        return
+    parquet_file = pq.ParquetFile(path)
+    types_mapper = {pa.int64(): pd.Int64Dtype()}.get
+    if parquet_file.metadata.num_rows == 0:
+        yield parquet_file.schema_arrow.empty_table().to_pandas(types_mapper=types_mapper)
+        return
+    expression = watermark_filter(parquet_file.schema_arrow, watermark) if watermark else None
+    for batch in parquet_file.iter_batches(batch_size=chunk_size):
+        if expression is not None:
+            batch = batch.filter(expression)
+        yield batch.to_pandas(types_mapper=types_mapper)
+
+
+def iter_table_parquet_batches(database_name, table_name, chunk_size, output_folder=parquet_folder, watermark=None):
+    """
+    Streams a converted table as Arrow record batches, the Parquet counterpart of
+    heliumplus_extract.iter_query_record_batches().
+    """
+    path = os.path.join(output_folder, database_name, f'{table_name}.parquet')
+    if not os.path.exists(path):
+        print(f"Table {table_name} does not exist in {output_folder}/{database_name}. Skipping this table.")
+        return
+    parquet_file = pq.ParquetFile(path)
+    if parquet_file.metadata.num_rows == 0:
+        schema = parquet_file.schema_arrow
+        yield pa.RecordBatch.from_arrays([pa.array([], type=field.type) for field in schema], schema=schema)
+        return
+    expression = watermark_filter(parquet_file.schema_arrow, watermark) if watermark else None
+    for batch in parquet_file.iter_batches(batch_size=chunk_size or parquet_file.metadata.num_rows):
+        yield batch if expression is None else batch.filter(expression)
+
+
+def main():
+    database_list_to_import(database_csv='databasename.csv', output_csv='import_database.csv')
+
+    database_list = pd.read_csv(os.path.abspath(os.getcwd()) + '/import_database.csv')
+    database_list = database_list.values.tolist()
+
+    jobs = []
+    for x in database_list:
+        dump_file_path = os.path.join(os.path.abspath(os.getcwd()), 'dumps-sql', f'{x[0]}.sql')
+        jobs.append((dump_file_path, x[1]))
+    jobs.sort(key=lambda job: os.path.getsize(job[0]), reverse=True)
+
+    with ProcessPoolExecutor(max_workers=max(1, parquet_max_workers)) as executor:
+        futures = [executor.submit(convert_dump_to_parquet, dump_file_path, database_name)
+                   for dump_file_path, database_name in jobs]
+        for future in futures:
+            future.result()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+import base64
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESSIV
+from cryptography.hazmat.primitives import padding
+from cryptography.hazmat.backends import default_backend
+
+import config_heliumplus
+
+
+BLOCK_SIZE = 16
+
+# Workers encrypting column shards concurrently (1 encrypts in the calling thread)
+encryption_workers = getattr(config_heliumplus, 'encryption_workers', os.cpu_count() or 1)
+
+# Rows per shard of a sensitive column handed to one worker
+encryption_shard_rows = getattr(config_heliumplus, 'encryption_shard_rows', 50000)
+
+# 'thread' (AES and numpy release the GIL) or 'process' (also parallelises padding and base64)
+encryption_executor = getattr(config_heliumplus, 'encryption_executor', 'thread')
+
+# 'random' (AES-CBC, new key and IVs every run) or 'deterministic' (AES-SIV with a
+# stable key, so an unchanged value encrypts to the same token on every run)
+encryption_mode = getattr(config_heliumplus, 'encryption_mode', 'random')
+
+# Base64 of the 64-byte AES-SIV key used in deterministic mode
+encryption_deterministic_key = getattr(config_heliumplus, 'encryption_deterministic_key', None)
+
+# Tokens remembered in deterministic mode (repeated addresses, names...), across all
+# columns and tables of the run; the least recently used are dropped beyond this
+token_cache_size = getattr(config_heliumplus, 'token_cache_size', 1000000)
+
+# {(key, column, value): token}, oldest use first
+_token_cache = OrderedDict()
+_token_cache_counts = {'hits': 0, 'misses': 0}
+_token_cache_lock = threading.Lock()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def encrypt_data(data, key):
+    """
+    Encrypts one value with AES-CBC and a random IV, returning base64(iv + ciphertext).
+    This is the per-cell reference implementation; encrypt_values() produces the same format in bulk.
+    """
+    iv = os.urandom(16)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    padded_data = padder.update(data.encode()) + padder.finalize()
+    encryptor = cipher.encryptor()
+    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
+    return base64.b64encode(iv + encrypted_data).decode()
+
+
+def decrypt_data(token, key):
+    """
+    Decrypts a value produced by encrypt_data() or encrypt_values().
+    """
+    raw = base64.b64decode(token)
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(raw[:16]), backend=default_backend()).decryptor()
+    padded_data = decryptor.update(raw[16:]) + decryptor.finalize()
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    return (unpadder.update(padded_data) + unpadder.finalize()).decode()
+
+
+def encrypt_values(values, key):
+    """
+    Encrypts a list of strings with AES-CBC, one random IV per value, in the same
+    base64(iv + ciphertext) format as encrypt_data().
+
+    Instead of a cipher, padder and encryptor per value, all IVs are drawn in one
+    os.urandom call and values are grouped by padded length. CBC is computed block
+    position by block position across a whole group: the XOR with the previous
+    ciphertext block (or IV) is done in numpy and the AES block encryption in a
+    single ECB call on the contiguous buffer, so the number of AES calls depends
+    on the number of distinct lengths, not on the number of values.
+
+    Returns:
+        list: Encrypted values, in the order of `values`.
+    """
+    count = len(values)
+    if count == 0:
+        return []
+
+    encoded = [value.encode() for value in values]
+    ivs = np.frombuffer(os.urandom(BLOCK_SIZE * count), dtype=np.uint8).reshape(count, BLOCK_SIZE)
+    encryptor = Cipher(algorithms.AES(key), modes.ECB(), backend=default_backend()).encryptor()
+
+    # PKCS7 always adds 1..16 bytes, so a value of n bytes takes n // 16 + 1 blocks
+    block_counts = np.fromiter((len(data) // BLOCK_SIZE + 1 for data in encoded), dtype=np.int64, count=count)
+    results = [None] * count
+
+    for blocks in np.unique(block_counts):
+        indexes = np.flatnonzero(block_counts == blocks)
+        size = int(blocks) * BLOCK_SIZE
+        padded = b''.join(encoded[i] + bytes([size - len(encoded[i])]) * (size - len(encoded[i])) for i in indexes)
+        plain = np.frombuffer(padded, dtype=np.uint8).reshape(len(indexes), int(blocks), BLOCK_SIZE)
+
+        group_ivs = ivs[indexes]
+        cipher_blocks = np.empty_like(plain)
+        previous = group_ivs
+        for position in range(int(blocks)):
+            mixed = np.bitwise_xor(plain[:, position, :], previous)
+            encrypted = np.frombuffer(encryptor.update(mixed.tobytes()), dtype=np.uint8)
+            previous = encrypted.reshape(len(indexes), BLOCK_SIZE)
+            cipher_blocks[:, position, :] = previous
+
+        tokens = np.concatenate([group_ivs, cipher_blocks.reshape(len(indexes), size)], axis=1)
+        row_size = tokens.shape[1]
+        buffer = tokens.tobytes()
+        b64encode = base64.b64encode
+        for row, i in enumerate(indexes):
+            results[i] = b64encode(buffer[row * row_size:(row + 1) * row_size]).decode()
+
+    encryptor.finalize()
+    return results
+
+
+def run_encryption_key():
+    """
+    Key for the tables of one run: a fresh random AES key, or in deterministic mode
+    the configured AES-SIV key, so tokens are stable across runs.
+    """
+    if encryption_mode != 'deterministic':
+        return os.urandom(32)
+    if not encryption_deterministic_key:
+        raise ValueError("encryption_mode is 'deterministic' but encryption_deterministic_key is not set")
+    key = base64.b64decode(encryption_deterministic_key)
+    if len(key) != 64:
+        raise ValueError(f"encryption_deterministic_key must be 64 bytes, got {len(key)}")
+    return key
+
+
+def tokenize_values(values, key, column, cache_size=token_cache_size):
+    """
+    Encrypts a list of strings deterministically with AES-SIV, returning base64(siv + ciphertext).
+    Equal values of a column give equal tokens, so tokens of unchanged rows do not change
+    between runs and a column can be joined across tables. The column name is authenticated
+    as associated data, so the same value gets a different token in another column
+    (e.g. fname and KinsFirstName) and columns cannot be linked to each other.
+    Tokens are memoized in one LRU cache of at most `cache_size` tokens shared by all
+    columns, so values repeated within a run are usually encrypted once.
+
+    Returns:
+        list: Tokens, in the order of `values`.
+    """
+    results, hits = _tokenize(values, key, column, cache_size)
+    _count_tokens(hits, len(values) - hits)
+    return results
+
+
+def _tokenize(values, key, column, cache_size=token_cache_size):
+    """
+    tokenize_values() without updating the hit/miss counts, which are returned instead,
+    so shards tokenized in worker processes are counted in the parent.
+
+    Returns:
+        tuple: (tokens, number of values found in the cache)
+    """
+    column = str(column)
+    with _token_cache_lock:
+        results = [_token_cache.get((key, column, value)) for value in values]
+        for value, token in zip(values, results):
+            if token is not None:
+                _token_cache.move_to_end((key, column, value))
+    hits = sum(token is not None for token in results)
+
+    # Encrypted outside the lock; a value repeated in `values` is encrypted once
+    siv = AESSIV(key)
+    associated_data = [column.encode()]
+    new_tokens = {}
+    for i, value in enumerate(values):
+        if results[i] is None:
+            token = new_tokens.get(value)
+            if token is None:
+                token = base64.b64encode(siv.encrypt(value.encode(), associated_data)).decode()
+                new_tokens[value] = token
+            else:
+                hits += 1
+            results[i] = token
+
+    if new_tokens and cache_size > 0:
+        with _token_cache_lock:
+            for value, token in new_tokens.items():
+                _token_cache[(key, column, value)] = token
+            while len(_token_cache) > cache_size:
+                _token_cache.popitem(last=False)
+    return results, hits
+
+
+def _count_tokens(hits, misses):
+    with _token_cache_lock:
+        _token_cache_counts['hits'] += hits
+        _token_cache_counts['misses'] += misses
+
+
+def detokenize(token, key, column):
+    """
+    Decrypts a value that tokenize_values() produced for `column`.
+    """
+    return AESSIV(key).decrypt(base64.b64decode(token), [str(column).encode()]).decode()
+
+
+def print_token_cache_stats():
+    total = _token_cache_counts['hits'] + _token_cache_counts['misses']
+    if total:
+        print(f"Token cache: {_token_cache_counts['hits']} of {total} values reused "
+              f"({100 * _token_cache_counts['hits'] / total:.0f}%)")
+
+
+def get_executor(workers=encryption_workers):
+    """
+    Pool shared by all tables of a run, created on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            pool_class = ProcessPoolExecutor if encryption_executor == 'process' else ThreadPoolExecutor
+            _executor = pool_class(max_workers=workers)
+        return _executor
+
+
+def encrypt_columns(columns, key, workers=encryption_workers, shard_rows=encryption_shard_rows,
+                    deterministic=None):
+    """
+    Encrypts several columns of values, sharding each column into row ranges of
+    `shard_rows` that are encrypted concurrently on the shared pool. Shards are
+    reassembled in submission order, so the result does not depend on scheduling.
+
+    In deterministic mode shards return their token cache hits, which are counted
+    here. With the 'process' executor each worker process keeps its own token cache,
+    so a value is reused across the shards of the same worker only.
+
+    Parameters:
+        columns (dict): {column name: list of str}; in deterministic mode the name is
+            the tokens' associated data.
+        key (bytes): AES key, or the AES-SIV key in deterministic mode.
+        deterministic (bool): Use tokenize_values(); defaults to encryption_mode.
+
+    Returns:
+        dict: {column name: list of encrypted str}, in the same order as the input.
+    """
+    if deterministic is None:
+        deterministic = encryption_mode == 'deterministic'
+    total = sum(len(values) for values in columns.values())
+    if workers <= 1 or total <= shard_rows:
+        if deterministic:
+            return {name: tokenize_values(values, key, name) for name, values in columns.items()}
+        return {name: encrypt_values(values, key) for name, values in columns.items()}
+
+    executor = get_executor(workers)
+    futures = {name: [executor.submit(_tokenize, values[start:start + shard_rows], key, name) if deterministic
+                      else executor.submit(encrypt_values, values[start:start + shard_rows], key)
+                      for start in range(0, len(values), shard_rows)]
+               for name, values in columns.items()}
+    encrypted = {}
+    for name, shards in futures.items():
+        encrypted[name] = []
+        for future in shards:
+            if deterministic:
+                tokens, hits = future.result()
+                _count_tokens(hits, len(tokens) - hits)
+            else:
+                tokens = future.result()
+            encrypted[name].extend(tokens)
+    return encrypted
+
+
+def encrypt_sensitive_columns(df, key, sensitive_columns):
+    """Encrypts sensitive columns in the DataFrame, all columns and row shards in parallel."""
+    masks = {}
+    columns = {}
+    for col in sensitive_columns:
+        if col in df.columns:
+            mask = df[col].notnull()
+            if mask.any():
+                masks[col] = mask
+                columns[col] = [str(value) for value in df[col][mask]]
+
+    for col, encrypted in encrypt_columns(columns, key).items():
+        result = df[col].astype(object).copy()
+        result[masks[col]] = encrypted
+        df[col] = result
+    return df
+
+
+def encrypt_arrow_columns(batch, key, sensitive_columns):
+    """
+    Encrypts sensitive columns of an Arrow record batch; encrypted columns become strings.
+    """
+    arrays = list(batch.columns)
+    names = batch.schema.names
+    values = {}
+    present = {}
+    for i, name in enumerate(names):
+        if name in sensitive_columns:
+            values[name] = arrays[i].to_pylist()
+            present[name] = [j for j, value in enumerate(values[name]) if value is not None]
+
+    # Keyed by column name, which deterministic tokens are bound to
+    encrypted = encrypt_columns({name: [str(values[name][j]) for j in present[name]] for name in values}, key)
+    for name, tokens in encrypted.items():
+        for j, token in zip(present[name], tokens):
+            values[name][j] = token
+        arrays[names.index(name)] = pa.array(values[name], type=pa.string())
+    return pa.RecordBatch.from_arrays(arrays, names=batch.schema.names)
@@ -0,0 +1,166 @@
+import os
+import resource
+
+from mysql.connector import FieldType
+import pandas as pd
+import pyarrow as pa
+
+import config_heliumplus
+from heliumplus_mysql_pool import mysql_connection
+
+
+# Rows fetched per chunk when tables are streamed from MySQL (0 reads each table in one piece)
+extract_chunk_size = getattr(config_heliumplus, 'extract_chunk_size', 100000)
+
+# Seconds MySQL waits on a streamed result while the pipeline is busy loading earlier
+# chunks; past net_write_timeout (60s by default) the server drops the connection mid-table
+extract_net_write_timeout = getattr(config_heliumplus, 'extract_net_write_timeout', 3600)
+
+# Build typed Arrow record batches from the cursor instead of object-dtype DataFrames
+extract_arrow = getattr(config_heliumplus, 'extract_arrow', False)
+
+INTEGER_FIELD_TYPES = {FieldType.TINY, FieldType.SHORT, FieldType.LONG, FieldType.LONGLONG,
+                       FieldType.INT24, FieldType.YEAR}
+FLOAT_FIELD_TYPES = {FieldType.FLOAT, FieldType.DOUBLE, FieldType.DECIMAL, FieldType.NEWDECIMAL}
+DATE_FIELD_TYPES = {FieldType.DATE, FieldType.NEWDATE}
+DATETIME_FIELD_TYPES = {FieldType.DATETIME, FieldType.TIMESTAMP}
+
+
+def current_rss_mb():
+    """
+    Resident set size of this process in MB, or the peak RSS where /proc is not available.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb():
+    """
+    Peak resident set size of this process in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class RSSTracker:
+    """
+    Records the highest RSS sampled while one table is processed.
+    """
+
+    def __init__(self):
+        self.start_mb = current_rss_mb()
+        self.peak_mb = self.start_mb
+
+    def sample(self):
+        self.peak_mb = max(self.peak_mb, current_rss_mb())
+        return self.peak_mb
+
+
+def open_streaming_cursor(conn, query, params=None):
+    """
+    Runs a query on an unbuffered cursor, after raising the session's net_write_timeout
+    so the result can stay open while each chunk is encrypted and loaded.
+    """
+    cursor = conn.cursor(buffered=False)
+    cursor.execute('SET SESSION net_write_timeout = %s', (int(extract_net_write_timeout),))
+    cursor.execute(query, params)
+    return cursor
+
+
+def iter_query_chunks(mysql_config, query, chunk_size=extract_chunk_size, params=None):
+    """
+    Runs a query on an unbuffered (server-side) cursor of a pooled connection and
+    yields the result as DataFrames of at most `chunk_size` rows, so only one chunk
+    is held in memory.
+
+    Parameters:
+        mysql_config (dict): Keyword arguments for mysql.connector.connect.
+        query (str): SELECT statement to run.
+        chunk_size (int): Rows per DataFrame.
+        params (tuple): Values of the query's %s placeholders.
+
+    Yields:
+        pd.DataFrame: The next chunk of rows.
+    """
+    with mysql_connection(mysql_config) as conn:
+        cursor = open_streaming_cursor(conn, query, params)
+        columns = list(cursor.column_names)
+        chunks = 0
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunks += 1
+            # coerce_float matches pd.read_sql, which loads DECIMAL columns as floats
+            yield pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+        if not chunks:
+            # Empty table, still yield its columns so the destination table can be created
+            yield pd.DataFrame(columns=columns)
+        cursor.close()
+
+
+def arrow_type_for(type_code):
+    """
+    Arrow type of a MySQL result column, from the cursor's description type code.
+    DECIMAL becomes float64 and DATE a timestamp, as in the pandas path.
+    """
+    if type_code in INTEGER_FIELD_TYPES or type_code == FieldType.BIT:
+        return pa.int64()
+    if type_code in FLOAT_FIELD_TYPES:
+        return pa.float64()
+    if type_code in DATE_FIELD_TYPES or type_code in DATETIME_FIELD_TYPES:
+        return pa.timestamp('us')
+    return pa.string()
+
+
+def column_to_arrow(values, type_code):
+    """
+    Builds a typed Arrow array from one column of fetched rows.
+    """
+    if type_code in INTEGER_FIELD_TYPES:
+        return pa.array(values, type=pa.int64())
+    if type_code == FieldType.BIT:
+        return pa.array([None if v is None else int.from_bytes(v, 'big') if isinstance(v, (bytes, bytearray)) else int(v)
+                         for v in values], type=pa.int64())
+    if type_code in FLOAT_FIELD_TYPES:
+        return pa.array([None if v is None else float(v) for v in values], type=pa.float64())
+    if type_code in DATE_FIELD_TYPES:
+        return pa.array(values, type=pa.date32()).cast(pa.timestamp('us'))
+    if type_code in DATETIME_FIELD_TYPES:
+        return pa.array(values, type=pa.timestamp('us'))
+    return pa.array([v if v is None or isinstance(v, str)
+                     else v.decode('utf-8', errors='replace') if isinstance(v, (bytes, bytearray))
+                     else str(v)
+                     for v in values], type=pa.string())
+
+
+def iter_query_record_batches(mysql_config, query, chunk_size=extract_chunk_size, params=None):
+    """
+    Runs a query on an unbuffered cursor and yields typed Arrow record batches of at
+    most `chunk_size` rows (the whole result when chunk_size is 0). Column types come
+    from the cursor metadata, so no object-dtype DataFrame or per-column cast is needed.
+    An empty result yields one empty batch carrying the schema.
+    """
+    with mysql_connection(mysql_config) as conn:
+        cursor = open_streaming_cursor(conn, query, params)
+        names = [column[0] for column in cursor.description]
+        type_codes = [column[1] for column in cursor.description]
+        schema = pa.schema([pa.field(name, arrow_type_for(type_code)) for name, type_code in zip(names, type_codes)])
+        batches = 0
+        while True:
+            rows = cursor.fetchmany(chunk_size) if chunk_size else cursor.fetchall()
+            if not rows:
+                break
+            batches += 1
+            columns = list(zip(*rows))
+            arrays = [column_to_arrow(list(values), type_code) for values, type_code in zip(columns, type_codes)]
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+            if not chunk_size:
+                break
+        if not batches:
+            yield pa.RecordBatch.from_arrays([pa.array([], type=field.type) for field in schema], schema=schema)
+        cursor.close()
+
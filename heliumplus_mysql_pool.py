@@ -0,0 +1,137 @@
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+
+import config_heliumplus
+
+
+# Connections open at the same time per database (in use and idle); an import holds
+# one for the DDL while its table workers take the others
+mysql_pool_size = getattr(config_heliumplus, 'mysql_pool_size', 5)
+
+# An idle connection older than this is pinged before it is reused
+mysql_pool_ping_seconds = getattr(config_heliumplus, 'mysql_pool_ping_seconds', 30)
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pool_counts = {'opened': 0, 'reused': 0, 'discarded': 0}
+_counts_lock = threading.Lock()
+
+
+def _count(name):
+    with _counts_lock:
+        _pool_counts[name] += 1
+
+
+def _pool_key(mysql_config):
+    return (mysql_config.get('host'), mysql_config.get('port'), mysql_config.get('user'), mysql_config.get('database'))
+
+
+def _pool(mysql_config, size):
+    with _pools_lock:
+        key = _pool_key(mysql_config)
+        if key not in _pools:
+            _pools[key] = {'slots': threading.BoundedSemaphore(max(1, size)), 'idle': [], 'lock': threading.Lock()}
+        return _pools[key]
+
+
+def _healthy(conn, idle_since, ping_seconds):
+    if time.monotonic() - idle_since < ping_seconds:
+        return True
+    try:
+        conn.ping(reconnect=False)
+        return True
+    except mysql.connector.Error:
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except mysql.connector.Error:
+        pass
+
+
+@contextmanager
+def mysql_connection(mysql_config, size=mysql_pool_size, ping_seconds=mysql_pool_ping_seconds):
+    """
+    Borrows a connection to `mysql_config['database']` from the pool of that database,
+    so the tables of a clinic reuse a few connections instead of opening one each.
+    Waits while `size` connections of the database are in use. An idle connection is
+    pinged before reuse when it has been idle longer than `ping_seconds`, and replaced
+    if the ping fails.
+
+    The connection's transaction is rolled back when it is returned, so the next user
+    does not read from an old snapshot. A connection is closed instead of returned if
+    the block raised (including a generator closed while reading a result).
+
+    Parameters:
+        mysql_config (dict): Keyword arguments for mysql.connector.connect.
+
+    Yields:
+        MySQLConnection: The connection, only to be used inside the block.
+    """
+    pool = _pool(mysql_config, size)
+    pool['slots'].acquire()
+    conn = None
+    try:
+        while conn is None:
+            with pool['lock']:
+                idle = pool['idle'].pop() if pool['idle'] else None
+            if idle is None:
+                conn = mysql.connector.connect(**mysql_config)
+                _count('opened')
+            elif _healthy(idle[0], idle[1], ping_seconds):
+                conn = idle[0]
+                _count('reused')
+            else:
+                _close(idle[0])
+                _count('discarded')
+
+        try:
+            yield conn
+        except BaseException:
+            _close(conn)
+            _count('discarded')
+            raise
+
+        try:
+            if conn.unread_result:
+                raise mysql.connector.InterfaceError('unread result')
+            conn.rollback()
+        except mysql.connector.Error:
+            _close(conn)
+            _count('discarded')
+            return
+        with pool['lock']:
+            pool['idle'].append((conn, time.monotonic()))
+    finally:
+        pool['slots'].release()
+
+
+def close_idle_connections(database=None):
+    """
+    Closes the idle connections of one database, or of every database.
+    """
+    with _pools_lock:
+        pools = [pool for key, pool in _pools.items() if database is None or key[3] == database]
+    for pool in pools:
+        with pool['lock']:
+            idle, pool['idle'] = pool['idle'], []
+        for conn, _ in idle:
+            _close(conn)
+
+
+def pool_counts():
+    with _counts_lock:
+        return dict(_pool_counts)
+
+
+def print_pool_counts(counts=None):
+    counts = pool_counts() if counts is None else counts
+    total = counts['opened'] + counts['reused']
+    if total:
+        print(f"MySQL connections: {counts['opened']} opened, {counts['reused']} reused "
+              f"({100 * counts['reused'] / total:.0f}% of {total}), {counts['discarded']} discarded")
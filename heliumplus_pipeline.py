@@ -0,0 +1,197 @@
+import queue
+import threading
+import time
+
+import config_heliumplus
+
+
+# Run extract, transform and load of a table's chunks as concurrent stages
+sync_pipeline = getattr(config_heliumplus, 'sync_pipeline', True)
+
+# Chunks waiting between two stages; bounds the memory held by the pipeline
+pipeline_queue_size = getattr(config_heliumplus, 'pipeline_queue_size', 2)
+
+_DONE = object()
+
+# {stage: {'busy', 'starved', 'blocked', 'items'}} summed over every table of the run
+stage_metrics = {}
+_metrics_lock = threading.Lock()
+
+
+class PipelineStopped(Exception):
+    """Raised in a stage thread when another stage failed."""
+
+
+def _record(stage, busy, starved, blocked, items):
+    with _metrics_lock:
+        metrics = stage_metrics.setdefault(stage, {'busy': 0.0, 'starved': 0.0, 'blocked': 0.0, 'items': 0})
+        metrics['busy'] += busy
+        metrics['starved'] += starved
+        metrics['blocked'] += blocked
+        metrics['items'] += items
+
+
+def _put(q, item, stop):
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q, stop):
+    while True:
+        if stop.is_set():
+            raise PipelineStopped()
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+
+def run_pipeline(source, stages, queue_size=pipeline_queue_size, source_name='extract'):
+    """
+    Streams the items of `source` through `stages`, each stage in its own thread and
+    connected to the next by a queue of at most `queue_size` items, so the next chunk
+    is extracted and transformed while the previous one is loading. Stages see items
+    in source order. A stage returning None drops the item.
+
+    For every stage the time spent working (busy), waiting for input (starved) and
+    waiting for room downstream (blocked) is added to stage_metrics; the stage with
+    the highest busy time is the bottleneck. The first exception raised by the source
+    or a stage stops the pipeline and is re-raised.
+
+    Parameters:
+        source (iterable): Items to process, e.g. the chunks of a table.
+        stages (list): (name, function) pairs applied in order.
+
+    Returns:
+        list: Outputs of the last stage.
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=max(1, queue_size)) for _ in stages]
+    results = []
+
+    def fail(e):
+        if not isinstance(e, PipelineStopped):
+            errors.append(e)
+        stop.set()
+
+    def produce():
+        busy = blocked = 0.0
+        items = 0
+        try:
+            iterator = iter(source)
+            while True:
+                start = time.monotonic()
+                item = next(iterator, _DONE)
+                busy += time.monotonic() - start
+                if item is _DONE:
+                    break
+                items += 1
+                start = time.monotonic()
+                _put(queues[0], item, stop)
+                blocked += time.monotonic() - start
+            _put(queues[0], _DONE, stop)
+        except BaseException as e:
+            fail(e)
+        finally:
+            _record(source_name, busy, 0.0, blocked, items)
+
+    def consume(index, name, function):
+        busy = starved = blocked = 0.0
+        items = 0
+        output = queues[index + 1] if index + 1 < len(stages) else None
+        try:
+            while True:
+                start = time.monotonic()
+                item = _get(queues[index], stop)
+                starved += time.monotonic() - start
+                if item is _DONE:
+                    break
+                start = time.monotonic()
+                item = function(item)
+                busy += time.monotonic() - start
+                items += 1
+                if item is None:
+                    continue
+                if output is None:
+                    results.append(item)
+                else:
+                    start = time.monotonic()
+                    _put(output, item, stop)
+                    blocked += time.monotonic() - start
+            if output is not None:
+                _put(output, _DONE, stop)
+        except BaseException as e:
+            fail(e)
+        finally:
+            _record(name, busy, starved, blocked, items)
+
+    threads = [threading.Thread(target=produce, name=source_name, daemon=True)]
+    threads += [threading.Thread(target=consume, args=(i, name, function), name=name, daemon=True)
+                for i, (name, function) in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+    return results
+
+
+def run_stages(source, stages, pipelined=sync_pipeline, queue_size=pipeline_queue_size):
+    """
+    run_pipeline() when pipelining is on, otherwise the same stages one item at a
+    time in the calling thread (still recording stage_metrics).
+    """
+    if pipelined:
+        return run_pipeline(source, stages, queue_size)
+
+    results = []
+    busy = {name: 0.0 for name in ['extract'] + [name for name, _ in stages]}
+    counts = dict.fromkeys(busy, 0)
+    iterator = iter(source)
+    try:
+        while True:
+            start = time.monotonic()
+            item = next(iterator, _DONE)
+            busy['extract'] += time.monotonic() - start
+            if item is _DONE:
+                break
+            counts['extract'] += 1
+            for name, function in stages:
+                start = time.monotonic()
+                item = function(item)
+                busy[name] += time.monotonic() - start
+                counts[name] += 1
+                if item is None:
+                    break
+            else:
+                results.append(item)
+    finally:
+        for name in busy:
+            _record(name, busy[name], 0.0, 0.0, counts[name])
+    return results
+
+
+def print_stage_metrics(seconds):
+    """
+    Prints each stage's share of the run's wall time spent working, starved of input
+    and blocked by the next stage; summed over tables synced in parallel, so a share
+    above 100% means the stage was busy in several tables at once.
+    """
+    with _metrics_lock:
+        metrics = {stage: dict(values) for stage, values in stage_metrics.items()}
+    if not metrics or not seconds:
+        return
+    bottleneck = max(metrics, key=lambda stage: metrics[stage]['busy'])
+    for stage, values in metrics.items():
+        print(f"Stage {stage:<10} {values['items']:>7} chunks, busy {100 * values['busy'] / seconds:5.0f}%, "
+              f"starved {100 * values['starved'] / seconds:5.0f}%, blocked {100 * values['blocked'] / seconds:5.0f}%"
+              f"{'  <- bottleneck' if stage == bottleneck else ''}")
@@ -0,0 +1,109 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import config_heliumplus
+
+
+# Stage only new or changed rows of tables with an id column in the merge sync
+row_hash_change_detection = getattr(config_heliumplus, 'row_hash_change_detection', False)
+
+# Folder of the per-table {id: row hash} indexes, one sub-folder per database
+row_hash_folder = getattr(config_heliumplus, 'row_hash_folder', 'row-hashes')
+
+
+# Stands for NULL in the normalised values, so it never equals a stringified value
+NULL_VALUE = '\x00NULL'
+
+
+def normalized_values(series):
+    """
+    Values of a column as strings that do not depend on its dtype: integral floats (an
+    integer column with NULLs read into float64) as integers, and NULLs as NULL_VALUE.
+    """
+    null = series.isna().to_numpy()
+    strings = series.astype(str).to_numpy(dtype=object)
+    if pd.api.types.is_float_dtype(series.dtype):
+        values = series.to_numpy(dtype='float64', na_value=np.nan)
+        with np.errstate(invalid='ignore'):
+            integral = ~null & (np.mod(values, 1) == 0) & (np.abs(values) < 2 ** 63)
+        strings[integral] = values[integral].astype('int64').astype(str)
+    strings[null] = NULL_VALUE
+    return strings
+
+
+def row_hashes(chunk):
+    """
+    64-bit content hash of every row of a DataFrame or record batch, computed on the
+    extracted values before encryption, so it only changes when the row changes. The
+    values are hashed in a normalised form, so a row hashes the same whether or not
+    NULLs elsewhere in its chunk changed the dtypes its columns were read with.
+    """
+    if isinstance(chunk, pa.RecordBatch):
+        chunk = chunk.to_pandas()
+    normalized = pd.DataFrame({column: normalized_values(chunk[column]) for column in chunk.columns})
+    return pd.util.hash_pandas_object(normalized, index=False).to_numpy()
+
+
+class RowHashIndex:
+    """
+    The {id: row hash} index of one table from the previous run, and the hashes of the
+    rows seen in this run. Rows whose hash matches the previous run are dropped from
+    the chunks to stage; the index is only saved once the table has been merged.
+    """
+
+    def __init__(self, database_name, table_name, folder=row_hash_folder):
+        self.path = os.path.join(folder, database_name, f'{table_name}.parquet')
+        if os.path.exists(self.path):
+            index = pq.read_table(self.path).to_pandas()
+            self.previous = pd.Series(index['hash'].to_numpy(), index=index['id'])
+        else:
+            self.previous = pd.Series(dtype='uint64')
+        self.seen = []
+        self.counts = {'new': 0, 'changed': 0, 'unchanged': 0}
+
+    def filter(self, chunk):
+        """
+        Records the hashes of a chunk and returns only its new or changed rows.
+        """
+        hashes = row_hashes(chunk)
+        ids = pd.Index(chunk.column('id').to_pandas() if isinstance(chunk, pa.RecordBatch) else chunk['id'])
+        self.seen.append(pd.Series(hashes, index=ids))
+
+        # Positions rather than reindex(), which would turn the uint64 hashes into floats
+        positions = self.previous.index.get_indexer(ids)
+        new = positions == -1
+        changed = ~new
+        changed[~new] = self.previous.to_numpy()[positions[~new]] != hashes[~new]
+        keep = new | changed
+        self.counts['new'] += int(new.sum())
+        self.counts['changed'] += int(changed.sum())
+        self.counts['unchanged'] += int((~keep).sum())
+
+        if keep.all():
+            return chunk
+        if isinstance(chunk, pa.RecordBatch):
+            return chunk.filter(pa.array(keep))
+        return chunk[keep]
+
+    def save(self):
+        """
+        Writes the index of this run, keeping entries of ids not extracted this time
+        (e.g. rows before the watermark of an incremental sync).
+        """
+        if not self.seen:
+            return
+        current = pd.concat(self.seen)
+        current = current[~current.index.duplicated(keep='last')]
+        index = pd.concat([self.previous[~self.previous.index.isin(current.index)], current])
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        pq.write_table(pa.table({'id': index.index.to_numpy(), 'hash': index.to_numpy(dtype='uint64')}), tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def print_counts(self, table_id):
+        print(f"{table_id}: {self.counts['new']} new, {self.counts['changed']} changed, "
+              f"{self.counts['unchanged']} unchanged rows")
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import re
+import threading
+
+import mysql.connector
+import pandas as pd
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+
+import config_heliumplus
+from heliumplus_bigquery import arrow_bq_schema
+from heliumplus_dump_to_parquet import DATETIME_TYPES, FLOAT_TYPES, INTEGER_TYPES, parquet_folder
+from heliumplus_mysql_pool import mysql_connection
+
+
+# Column types of previously seen tables: {database.table: {ddl_hash, columns: [[name, type]]}}
+schema_cache_path = getattr(config_heliumplus, 'schema_cache_path', 'schema_cache.json')
+
+# The counter in SHOW CREATE TABLE changes with every insert, not with the table definition
+AUTO_INCREMENT = re.compile(r'\s+AUTO_INCREMENT=\d+')
+
+_schema_cache = None
+_schema_cache_lock = threading.Lock()
+
+
+def bq_type(mysql_type):
+    """
+    BigQuery type of a MySQL column type (INFORMATION_SCHEMA.COLUMNS.DATA_TYPE), with
+    the mapping generate_bq_schema() applies to the DataFrames read from it.
+    """
+    mysql_type = mysql_type.lower()
+    if mysql_type in INTEGER_TYPES:
+        return 'INTEGER'
+    if mysql_type in FLOAT_TYPES:
+        return 'FLOAT'
+    if mysql_type in DATETIME_TYPES:
+        return 'DATETIME'
+    return 'STRING'
+
+
+def load_schema_cache(path=schema_cache_path):
+    global _schema_cache
+    with _schema_cache_lock:
+        if _schema_cache is None:
+            _schema_cache = {}
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    _schema_cache = json.load(f)
+        return _schema_cache
+
+
+def save_schema_cache(path=schema_cache_path):
+    """
+    Writes the schema cache atomically so an interrupted run never leaves it truncated.
+    """
+    with _schema_cache_lock:
+        if _schema_cache is None:
+            return
+        snapshot = dict(_schema_cache)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def mysql_table_schema(mysql_config, table_name, sensitive_columns=()):
+    """
+    BigQuery schema of a MySQL table from its column metadata, without reading any rows.
+
+    The table's DDL is hashed and the column types are only read from
+    INFORMATION_SCHEMA when the DDL differs from the cached one, so an unchanged table
+    costs a single SHOW CREATE TABLE. Sensitive columns are STRING, as they are loaded
+    encrypted.
+
+    Returns:
+        list: bigquery.SchemaField per column, or None if the table does not exist.
+    """
+    cache = load_schema_cache()
+    key = f"{mysql_config['database']}.{table_name}"
+
+    with mysql_connection(mysql_config) as conn:
+        cursor = conn.cursor()
+        try:
+            try:
+                cursor.execute(f'SHOW CREATE TABLE `{table_name}`')
+            except mysql.connector.ProgrammingError:
+                return None
+            ddl = AUTO_INCREMENT.sub('', cursor.fetchone()[1])
+            ddl_hash = hashlib.sha256(ddl.encode()).hexdigest()
+
+            entry = cache.get(key)
+            if entry is None or entry['ddl_hash'] != ddl_hash:
+                cursor.execute("SELECT COLUMN_NAME, DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS "
+                               "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION",
+                               (table_name,))
+                entry = {'ddl_hash': ddl_hash, 'columns': [[name, bq_type(data_type)] for name, data_type in cursor.fetchall()]}
+                with _schema_cache_lock:
+                    cache[key] = entry
+        finally:
+            cursor.close()
+
+    return [bigquery.SchemaField(name, 'STRING' if name in sensitive_columns else field_type)
+            for name, field_type in entry['columns']]
+
+
+def parquet_table_schema(database_name, table_name, sensitive_columns=(), output_folder=parquet_folder):
+    """
+    BigQuery schema of a converted table from its Parquet schema, or None if the table was not in the dump.
+    """
+    path = os.path.join(output_folder, database_name, f'{table_name}.parquet')
+    if not os.path.exists(path):
+        return None
+    return [bigquery.SchemaField(field.name, 'STRING') if field.name in sensitive_columns else field
+            for field in arrow_bq_schema(pq.read_schema(path))]
+
+
+def reconcile_schema(schema, target_schema):
+    """
+    Keeps the type of columns that already exist in the BigQuery table, so a staged
+    table can always be merged into it; new columns keep their inferred type.
+    """
+    if not target_schema:
+        return schema
+    target_types = {field.name: field.field_type for field in target_schema}
+    return [bigquery.SchemaField(field.name, target_types.get(field.name, field.field_type)) for field in schema]
+
+
+def convert_column(series, field_type):
+    if field_type == 'DATETIME':
+        if not pd.api.types.is_datetime64_any_dtype(series):
+            series = pd.to_datetime(series, errors='coerce')
+        return series.astype('datetime64[ns]')
+    if field_type == 'INTEGER':
+        if not pd.api.types.is_numeric_dtype(series):
+            # BIT columns are read as bytes
+            series = series.map(lambda v: int.from_bytes(v, 'big') if isinstance(v, (bytes, bytearray)) else v)
+            series = pd.to_numeric(series, errors='coerce')
+        return series.astype('Int64')
+    if field_type == 'FLOAT':
+        if not pd.api.types.is_numeric_dtype(series):
+            series = pd.to_numeric(series, errors='coerce')
+        return series.astype('float64')
+    if pd.api.types.is_datetime64_any_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        # A typed column loaded into a STRING column (e.g. a date column first seen empty)
+        return series.astype(str).astype(object).where(series.notna(), None)
+    return series.astype(object)
+
+
+def apply_schema(df, schema, source_schema=None):
+    """
+    Converts every column of a DataFrame to its BigQuery type in a single pass, in place
+    of date detection, generate_bq_schema() and map_pandas_dtypes(). With the inferred
+    `source_schema` of a reconciled schema, columns whose type differs are first
+    converted to their source type (e.g. dates to datetime64 before STRING).
+    """
+    if source_schema is not None:
+        target_types = {field.name: field.field_type for field in schema}
+        changed = [field for field in source_schema if target_types.get(field.name, field.field_type) != field.field_type]
+        if changed:
+            df = apply_schema(df, changed)
+    converted = {field.name: convert_column(df[field.name], field.field_type)
+                 for field in schema if field.name in df.columns}
+    return df.assign(**converted)
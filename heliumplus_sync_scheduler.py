@@ -0,0 +1,93 @@
+import time
+import traceback
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import config_heliumplus
+
+
+# Tables synced at the same time; most of a table's sync is spent waiting on BigQuery jobs
+sync_max_workers = getattr(config_heliumplus, 'sync_max_workers', 4)
+
+# Tables of one database (clinic) synced at the same time, so a large clinic cannot take every slot
+sync_max_per_database = getattr(config_heliumplus, 'sync_max_per_database', 2)
+
+
+def run_table_syncs(tables, sync, max_workers=sync_max_workers, max_per_database=sync_max_per_database,
+                    on_done=None):
+    """
+    Runs sync(database, table, *args) for every table on a thread pool, with at most
+    `max_workers` tables in flight and at most `max_per_database` of them from the same
+    database. Databases are served round-robin, so every clinic makes progress instead
+    of waiting for the clinics listed before it. An exception fails only its table.
+
+    `sync` is any callable, so the scheduler can be exercised with a fake sync function
+    or a sync script whose BigQuery client has been replaced.
+
+    Parameters:
+        tables (list): (database, table, *args) tuples, in tablename.csv order.
+        sync (callable): Syncs one table.
+        on_done (callable): Called in the scheduling thread with each result as it completes.
+
+    Returns:
+        list: One {database, table, status, seconds, error, value} dict per table, in input
+        order, where value is what sync returned.
+    """
+    queues = {}
+    for position, entry in enumerate(tables):
+        queues.setdefault(entry[0], deque()).append((position, entry))
+    databases = deque(queues)
+    in_flight = {database: 0 for database in queues}
+    results = [None] * len(tables)
+    running = {}
+
+    def run(entry):
+        start = time.monotonic()
+        try:
+            value = sync(*entry)
+            return {'status': 'ok', 'seconds': time.monotonic() - start, 'error': None, 'value': value}
+        except Exception as e:
+            traceback.print_exc()
+            return {'status': 'failed', 'seconds': time.monotonic() - start, 'error': repr(e), 'value': None}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while databases or running:
+            # Fill free slots round-robin over the databases that are under their own limit
+            skipped = 0
+            while databases and len(running) < max_workers and skipped < len(databases):
+                database = databases[0]
+                databases.rotate(-1)
+                if in_flight[database] >= max_per_database:
+                    skipped += 1
+                    continue
+                skipped = 0
+                position, entry = queues[database].popleft()
+                if not queues[database]:
+                    databases.remove(database)
+                in_flight[database] += 1
+                running[executor.submit(run, entry)] = (position, entry)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                position, entry = running.pop(future)
+                in_flight[entry[0]] -= 1
+                result = {'database': entry[0], 'table': entry[1], **future.result()}
+                results[position] = result
+                if on_done is not None:
+                    on_done(result)
+
+    return results
+
+
+def print_sync_summary(results, seconds):
+    """
+    Prints the tables synced and failed, the slowest tables and the run's wall time.
+    """
+    failed = [result for result in results if result['status'] != 'ok']
+    busy = sum(result['seconds'] for result in results)
+    print(f"Synced {len(results) - len(failed)} of {len(results)} tables in {seconds:.0f}s "
+          f"({busy:.0f}s of table time, {busy / seconds if seconds else 0:.1f} tables in flight on average)")
+    for result in sorted(results, key=lambda r: r['seconds'], reverse=True)[:5]:
+        print(f"  slowest: {result['database']}.{result['table']} {result['seconds']:.0f}s")
+    for result in failed:
+        print(f"  failed: {result['database']}.{result['table']}: {result['error']}")
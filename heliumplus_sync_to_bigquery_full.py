@@ -1,27 +1,37 @@
 # Step 1: Install necessary libraries
 # !pip install mysql-connector-python google-cloud-bigquery pandas
 
-import mysql.connector
 from google.cloud import bigquery
 import pandas as pd
 import os
-from datetime import datetime, date
+import time
+from datetime import date
 import config_heliumplus
+from heliumplus_bigquery import arrow_bq_schema, bigquery_client, load_arrow_table, table_metadata
+from heliumplus_dump_to_parquet import iter_table_parquet_batches, iter_table_parquet_chunks, read_table_parquet
+from heliumplus_encryption import (encrypt_arrow_columns, encrypt_sensitive_columns, print_token_cache_stats,
+                                   run_encryption_key)
+from heliumplus_sync_scheduler import print_sync_summary, run_table_syncs
+from heliumplus_pipeline import print_stage_metrics, run_stages
+from heliumplus_mysql_pool import close_idle_connections, mysql_connection, print_pool_counts
+from heliumplus_schema import apply_schema, mysql_table_schema, parquet_table_schema, save_schema_cache
+from heliumplus_extract import (RSSTracker, extract_arrow, extract_chunk_size, iter_query_chunks,
+                                iter_query_record_batches)
 
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.backends import default_backend
-import base64
 
+# Step 2: Google Cloud credentials are read by bigquery_client() when BigQuery is first used
 
-# Step 2: Set up Google Cloud credentials
-client = bigquery.Client.from_service_account_json(os.path.abspath(os.getcwd()) + '/heliumhealth-1ce77f433fc7.json')
+# Where table data is read from: 'mysql' (imported dumps) or 'parquet' (output of heliumplus_dump_to_parquet.py)
+sync_source = getattr(config_heliumplus, 'sync_source', 'mysql')
 
+# Replace tables with write-truncate loads (through a staging table when loaded in chunks)
+# instead of dropping them first, so a table is never missing or half-loaded
+atomic_swap = getattr(config_heliumplus, 'atomic_swap', True)
 
-# Step 3: Extract data from MySQL
-def extract_data_from_mysql(database_name,table_name):
+
+def mysql_config_for(database_name):
     # MySQL connection details
-    mysql_config = {
+    return {
         'user': config_heliumplus.mysql_username,
         'password': config_heliumplus.mysql_password,
         'host': 'localhost',
@@ -30,18 +40,26 @@ def extract_data_from_mysql(database_name,table_name):
          
     }
 
-    # SQL query to extract data
-    query = f'SELECT * FROM {table_name}'
-    
-
-    # Connect to MySQL and extract data into a DataFrame
-    conn = mysql.connector.connect(**mysql_config)
-    df = pd.read_sql(query, conn)
 
+def convert_date_columns(df):
     # Convert date columns from datetime.date to datetime.datetime
     for col in df.columns:
         if df[col].dtype == 'object' and df[col].apply(lambda x: isinstance(x, date)).all():
             df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+
+# Step 3: Extract data from MySQL
+def extract_data_from_mysql(database_name,table_name):
+    mysql_config = mysql_config_for(database_name)
+
+    # SQL query to extract data
+    query = f'SELECT * FROM {table_name}'
+    
+
+    # Extract data into a DataFrame over a pooled connection
+    with mysql_connection(mysql_config) as conn:
+        df = pd.read_sql(query, conn)
 
     # for col in df.columns:
     #     # Check if the column is of object type (string)
@@ -57,10 +75,35 @@ def extract_data_from_mysql(database_name,table_name):
     #             continue
 
 
-    conn.close()
     return df
 
 
+def extract_data_from_mysql_chunks(database_name, table_name, chunk_size=extract_chunk_size):
+    """Streams a table from MySQL in DataFrames of at most chunk_size rows."""
+    yield from iter_query_chunks(mysql_config_for(database_name), f'SELECT * FROM {table_name}', chunk_size)
+
+
+def extract_data(database_name, table_name):
+    """Reads a table from the configured sync_source."""
+    if sync_source == 'parquet':
+        return read_table_parquet(database_name, table_name)
+    return extract_data_from_mysql(database_name, table_name)
+
+
+def extract_data_chunks(database_name, table_name, chunk_size=extract_chunk_size):
+    """Streams a table from the configured sync_source in chunks."""
+    if sync_source == 'parquet':
+        return iter_table_parquet_chunks(database_name, table_name, chunk_size)
+    return extract_data_from_mysql_chunks(database_name, table_name, chunk_size)
+
+
+def extract_record_batches(database_name, table_name, chunk_size=extract_chunk_size):
+    """Streams a table from the configured sync_source as typed Arrow record batches."""
+    if sync_source == 'parquet':
+        return iter_table_parquet_batches(database_name, table_name, chunk_size)
+    return iter_query_record_batches(mysql_config_for(database_name), f'SELECT * FROM {table_name}', chunk_size)
+
+
 def generate_bq_schema(df):
     schema = []
     for column, dtype in df.dtypes.items():
@@ -107,76 +150,109 @@ def detect_and_convert_date_columns(df):
 
 
 def drop_bigquery_table_if_exists(client, table_id):
+    # Existence comes from the run's metadata cache, so missing tables cost no API call
+    _, dataset_id, table_name = table_id.split('.')
+    metadata = table_metadata(client)
+    if not metadata.exists(dataset_id, table_name):
+        print(f"Table '{table_id}' does not exist. Proceeding with data load.")
+        return
     try:
         client.delete_table(table_id)
+        metadata.deleted(dataset_id, table_name)
         print(f"Deleted table '{table_id}'.")
     except Exception as e:
         print(f"Table '{table_id}' does not exist. Proceeding with data load.")
 
 
-def encrypt_data(data, key):
-    # Generate a random 16 bytes IV (Initialization Vector)
-    iv = os.urandom(16)
-    
-    # Create a cipher object using the key and IV
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    
-    # Pad the data to be encrypted
-    padder = padding.PKCS7(algorithms.AES.block_size).padder()
-    padded_data = padder.update(data.encode()) + padder.finalize()
-    
-    # Encrypt the padded data
-    encryptor = cipher.encryptor()
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-    
-    # Return the IV and encrypted data encoded in base64 for storage
-    return base64.b64encode(iv + encrypted_data).decode()
+SENSITIVE_COLUMNS = ['fname','lname','mname','phonenumber','email','address','KinsFirstName','KinsLastName','KinsPhone','KinsAddress']
 
 
-def encrypt_sensitive_columns(df, key, sensitive_columns):
-    """Encrypts sensitive columns in the DataFrame."""
-    for col in sensitive_columns:
-        if col in df.columns:
-            df[col] = df[col].apply(lambda x: encrypt_data(x, key) if pd.notnull(x) else x)
-    return df
+def infer_table_schema(database_name, table_name):
+    """BigQuery schema of a table from the sync_source's column metadata, or None if unknown."""
+    if sync_source == 'parquet':
+        return parquet_table_schema(database_name, table_name, SENSITIVE_COLUMNS)
+    return mysql_table_schema(mysql_config_for(database_name), table_name, SENSITIVE_COLUMNS)
 
 
-def load_data_to_bigquery(df, database_name, table_name):
-    # BigQuery client
-    # client = bigquery.Client()
-    
-    # Generate a 32-byte key for encryption
-    encryption_key = os.urandom(32)
-
-    sensitive_columns = ['fname','lname','mname','phonenumber','email','address','KinsFirstName','KinsLastName','KinsPhone','KinsAddress']   
-
-    # Define the BigQuery table ID
-    table_id = f'heliumhealth.{database_name}.{table_name}'
-
-
-    # Drop existing table if it exists
-    drop_bigquery_table_if_exists(client, table_id)
+def prepare_dataframe(df, encryption_key, schema=None):
+    """
+    Encrypts the sensitive columns of a DataFrame and casts it to the BigQuery schema.
+    With a schema (inferred from column metadata, or from a previous chunk) all columns
+    are converted in one pass; otherwise dates are detected and the schema generated
+    from the data.
 
+    Returns:
+        tuple: (DataFrame, schema)
+    """
     # Encrypt sensitive columns
-    df = encrypt_sensitive_columns(df, encryption_key, sensitive_columns)
+    df = encrypt_sensitive_columns(df, encryption_key, SENSITIVE_COLUMNS)
 
     # Generate schema from DataFrame
-    schema = generate_bq_schema(df)
-
-    # Map schema to pandas dtypes
-    pandas_dtypes = map_pandas_dtypes(schema)
+    if schema is None:
+        df = convert_date_columns(df)
+        schema = generate_bq_schema(df)
 
     # Apply the correct dtypes to the DataFrame
-    for column, dtype in pandas_dtypes.items():
-        df[column] = df[column].astype(dtype)
-
+    df = apply_schema(df, schema)
 
     # Create an empty DataFrame with the schema if df is empty
     if df.empty:
+        pandas_dtypes = map_pandas_dtypes(schema)
         df = pd.DataFrame({field.name: pd.Series(dtype=pandas_dtypes[field.name]) for field in schema})
+    return df, schema
+
+
+def replace_write_disposition(client, table_id, append):
+    """
+    Write disposition of a load: WRITE_APPEND for the following chunks of a table, and
+    for the first one WRITE_TRUNCATE, which replaces the table's rows and schema in the
+    same job, or in drop mode (atomic_swap off) None after dropping the table.
+    """
+    if append:
+        return bigquery.WriteDisposition.WRITE_APPEND
+    if atomic_swap:
+        return bigquery.WriteDisposition.WRITE_TRUNCATE
+    drop_bigquery_table_if_exists(client, table_id)
+    return None
+
+
+def swap_staging_table(database_name, table_name):
+    """
+    Atomically replaces a table with its fully loaded `<table>_staging` copy, using a
+    write-truncate copy job. The staging table is dropped by drop_staging_table().
+    """
+    table_id = f'heliumhealth.{database_name}.{table_name}'
+    staging_id = f'{table_id}_staging'
+    client = bigquery_client()
+    job_config = bigquery.CopyJobConfig(write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE)
+    client.copy_table(staging_id, table_id, job_config=job_config).result()
+    table_metadata(client).added(database_name, table_name)
+    print(f'Replaced {table_id} with {staging_id}.')
+
+
+def drop_staging_table(database_name, table_name):
+    """
+    Drops `<table>_staging` after a swap, or after a failed chunked sync so the partly
+    loaded copy is not left behind.
+    """
+    client = bigquery_client()
+    client.delete_table(f'heliumhealth.{database_name}.{table_name}_staging', not_found_ok=True)
+    table_metadata(client).deleted(database_name, f'{table_name}_staging')
+
+
+def load_dataframe(df, database_name, table_name, schema, append=False):
+    """
+    Loads a prepared DataFrame into BigQuery, replacing the table unless append is set.
+    """
+    # Define the BigQuery table ID
+    table_id = f'heliumhealth.{database_name}.{table_name}'
 
     # Load data into BigQuery
+    client = bigquery_client()
     job_config = bigquery.LoadJobConfig(schema=schema)
+    write_disposition = replace_write_disposition(client, table_id, append)
+    if write_disposition is not None:
+        job_config.write_disposition = write_disposition
     job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
 
     # Wait for the load job to complete
@@ -185,6 +261,100 @@ def load_data_to_bigquery(df, database_name, table_name):
     print(f'Loaded {job.output_rows} rows into {table_id}.')
 
 
+def load_data_to_bigquery(df, database_name, table_name, schema=None, append=False, encryption_key=None):
+    """
+    Encrypts and loads a DataFrame into BigQuery, replacing the table.
+
+    When a table is loaded in chunks, the first chunk is loaded with append=False and
+    the following chunks with append=True and the schema returned by the first call,
+    so every chunk is cast to the same column types.
+
+    Returns:
+        list: The BigQuery schema used for the load.
+    """
+    # Key for encryption (random, or the stable key in deterministic mode)
+    if encryption_key is None:
+        encryption_key = run_encryption_key()
+
+    df, schema = prepare_dataframe(df, encryption_key, schema)
+    load_dataframe(df, database_name, table_name, schema, append)
+    return schema
+
+
+def load_arrow_batch(batch, database_name, table_name, append=False):
+    """
+    Loads an encrypted record batch as Parquet, replacing the table unless append is set.
+    """
+    table_id = f'heliumhealth.{database_name}.{table_name}'
+    client = bigquery_client()
+
+    job = load_arrow_table(client, batch, table_id, arrow_bq_schema(batch.schema),
+                           replace_write_disposition(client, table_id, append))
+    print(f'Loaded {job.output_rows} rows into {table_id}.')
+
+
+def sync_table(database_name, table_name):
+    """
+    Copies one table to BigQuery. With extract_chunk_size set, the table is streamed
+    from the source and encrypted and loaded chunk by chunk, so memory is bounded by
+    the chunk size rather than the table size. With extract_arrow set, chunks are typed
+    Arrow record batches instead of DataFrames. Chunks go through extract, transform
+    and load pipeline stages, so the next chunk is read while the previous one loads.
+
+    With atomic_swap, a table read in one piece replaces the table in a single
+    write-truncate load; chunks are loaded into `<table>_staging`, which then replaces
+    the table in one copy job. A failed sync leaves the previous table in place and
+    drops the staging table.
+    Prints the load and swap times and the peak RSS seen for the table.
+    """
+    start = time.monotonic()
+    swap_seconds = 0.0
+    rss = RSSTracker()
+    # Column types come from the source's metadata rather than from scanning the data
+    schema = None if extract_arrow else infer_table_schema(database_name, table_name)
+    if not extract_arrow and not extract_chunk_size:
+        df = extract_data(database_name, table_name)
+        rss.sample()
+        load_data_to_bigquery(df, database_name, table_name, schema=schema)
+    else:
+        loaded = False
+        encryption_key = run_encryption_key()
+        load_table = f'{table_name}_staging' if atomic_swap else table_name
+
+        def transform(chunk):
+            nonlocal schema
+            rss.sample()
+            if extract_arrow:
+                return encrypt_arrow_columns(chunk, encryption_key, SENSITIVE_COLUMNS)
+            chunk, schema = prepare_dataframe(chunk, encryption_key, schema)
+            return chunk, schema
+
+        def load(prepared):
+            nonlocal loaded
+            if extract_arrow:
+                load_arrow_batch(prepared, database_name, load_table, append=loaded)
+            else:
+                load_dataframe(prepared[0], database_name, load_table, prepared[1], append=loaded)
+            loaded = True
+            rss.sample()
+
+        source = extract_record_batches(database_name, table_name) if extract_arrow else extract_data_chunks(database_name, table_name)
+        try:
+            run_stages(source, [('transform', transform), ('load', load)])
+
+            if atomic_swap and loaded:
+                swap_start = time.monotonic()
+                swap_staging_table(database_name, table_name)
+                swap_seconds = time.monotonic() - swap_start
+        finally:
+            if atomic_swap:
+                # Also after a failed first load, which may have left a staging table behind
+                drop_staging_table(database_name, table_name)
+    rss.sample()
+    print(f'{database_name}.{table_name}: loaded in {time.monotonic() - start - swap_seconds:.1f}s, '
+          f'swapped in {swap_seconds:.1f}s, peak RSS {rss.peak_mb:.0f} MB (started at {rss.start_mb:.0f} MB)')
+
+
 
 # Main function to sync data from MySQL to BigQuery
 def main():
@@ -195,15 +365,19 @@ def main():
     # project_id = 'heliumhealth'
     
 
-    for x in tables_list:
-
-        # Extract data from MySQL
-        # df = extract_data_from_mysql(x[0],x[1])
-        df = extract_data_from_mysql(x[0], x[1])
-
-
-        # Load data into BigQuery
-        load_data_to_bigquery(df,x[0],x[1])
+    # Extract data from MySQL and load it into BigQuery, several tables at a time
+    start = time.monotonic()
+    results = run_table_syncs([(x[0], x[1]) for x in tables_list], sync_table)
+    print_sync_summary(results, time.monotonic() - start)
+    print_stage_metrics(time.monotonic() - start)
+    print_token_cache_stats()
+    print_pool_counts()
+    close_idle_connections()
+    save_schema_cache()
+
+    failed = [result for result in results if result['status'] != 'ok']
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} tables failed to sync")
 
 # Run the sync function
 if __name__ == '__main__':
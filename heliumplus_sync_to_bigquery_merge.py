@@ -3,25 +3,66 @@ from mysql.connector import errorcode
 from google.cloud import bigquery
 import pandas as pd
 import os
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date
+from itertools import groupby
+import pyarrow as pa
+import pyarrow.compute as pc
 import config_heliumplus
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives import padding
-from cryptography.hazmat.backends import default_backend
-import base64
+from download_heliumplus_dumps import confirm_manifest_entries
+from heliumplus_bigquery import arrow_bq_schema, bigquery_client, load_arrow_table, table_metadata
+from heliumplus_dump_to_parquet import iter_table_parquet_batches, iter_table_parquet_chunks, read_table_parquet
+from heliumplus_encryption import (encrypt_arrow_columns, encrypt_sensitive_columns, print_token_cache_stats,
+                                   run_encryption_key)
+from heliumplus_row_hashes import RowHashIndex, row_hash_change_detection
+from heliumplus_sync_scheduler import print_sync_summary, run_table_syncs, sync_max_workers
+from heliumplus_pipeline import print_stage_metrics, run_stages
+from heliumplus_mysql_pool import close_idle_connections, mysql_connection, print_pool_counts
+from heliumplus_schema import (apply_schema, mysql_table_schema, parquet_table_schema, reconcile_schema,
+                               save_schema_cache)
+from heliumplus_extract import (RSSTracker, extract_arrow, extract_chunk_size, iter_query_chunks,
+                                iter_query_record_batches)
 import warnings
 
 # Suppress specific warnings
 warnings.filterwarnings("ignore", category=UserWarning, message="pandas only support SQLAlchemy connectable")
 
 
-# Set up Google Cloud credentials
-client = bigquery.Client.from_service_account_json(os.path.abspath(os.getcwd()) + '/heliumhealth-1ce77f433fc7.json')
+# Google Cloud credentials are read by bigquery_client() when BigQuery is first used
 
+# Where table data is read from: 'mysql' (imported dumps) or 'parquet' (output of heliumplus_dump_to_parquet.py)
+sync_source = getattr(config_heliumplus, 'sync_source', 'mysql')
 
-def extract_data_from_mysql(database_name, table_name):
-    """Extract data from MySQL and handle the case where the table does not exist."""
-    mysql_config = {
+# Per-table watermarks of incremental syncs: {database.table: {column, value, synced_at}}
+sync_watermarks_path = getattr(config_heliumplus, 'sync_watermarks_path', 'sync_watermarks.json')
+
+# Guards the watermarks dict, updated by tables synced concurrently
+watermarks_lock = threading.Lock()
+
+# Replace the rows of tables without an id in one transaction (DELETE + INSERT of the temp
+# table's rows) instead of two separate queries
+atomic_swap = getattr(config_heliumplus, 'atomic_swap', True)
+
+# Merge the staged tables of a dataset in one BigQuery script instead of several jobs per table
+batched_merge = getattr(config_heliumplus, 'batched_merge', False)
+
+# Tables per merge script; datasets with more staged tables get several scripts
+merge_script_max_tables = getattr(config_heliumplus, 'merge_script_max_tables', 50)
+
+# Statements a merge script runs inside a transaction
+DML_STATEMENTS = ('DELETE', 'INSERT', 'MERGE', 'UPDATE')
+
+SENSITIVE_COLUMNS = ['fname', 'lname', 'mname', 'phonenumber', 'email', 'address', 'KinsFirstName', 'KinsLastName', 'KinsPhone', 'KinsAddress']
+
+# BigQuery DDL names of the column types produced by generate_bq_schema()
+DDL_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64'}
+
+
+def mysql_config_for(database_name):
+    return {
         'user': config_heliumplus.mysql_username,
         'password': config_heliumplus.mysql_password,
         'host': 'localhost',
@@ -29,20 +70,130 @@ def extract_data_from_mysql(database_name, table_name):
         'database': f'{database_name}',
     }
 
+
+def load_watermarks(path=sync_watermarks_path):
+    """
+    Loads the watermarks of incremental syncs: {database.table: {column, value, synced_at}}.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_watermarks(watermarks, path=sync_watermarks_path):
+    """
+    Writes the watermarks atomically so an interrupted run never leaves the file truncated.
+    """
+    with watermarks_lock:
+        snapshot = dict(watermarks)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(snapshot, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def table_query(table_name, watermark=None):
+    """
+    SELECT of a whole table, or of the rows from a (column, value) watermark on. The
+    rows at the watermark are read again, so rows committed later with the same value
+    are not missed; merging them again is harmless (see merge_data_in_bigquery()).
+
+    Returns:
+        tuple: (query, params)
+    """
+    if watermark is None:
+        return f'SELECT * FROM {table_name}', None
+    column, value = watermark
+    return f'SELECT * FROM {table_name} WHERE `{column}` >= %s', (value,)
+
+
+def chunk_max(chunk, column):
+    """
+    Highest value of `column` in a DataFrame or record batch, or None if it has no
+    such column or only nulls. Integral floats (an integer column with nulls read into
+    a DataFrame) are returned as int, so the stored watermark casts back to the column.
+    """
+    if isinstance(chunk, pa.RecordBatch):
+        if column not in chunk.schema.names:
+            return None
+        return pc.max(chunk.column(column)).as_py()
+    if column not in chunk.columns:
+        return None
+    value = chunk[column].max()
+    if pd.isna(value):
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return value
+
+
+def is_missing_table_error(err):
+    """True if a MySQL error (or the error pandas.read_sql wrapped it in) is ER_NO_SUCH_TABLE."""
+    cause = err if isinstance(err, mysql.connector.Error) else err.__cause__
+    return isinstance(cause, mysql.connector.Error) and cause.errno == errorcode.ER_NO_SUCH_TABLE
+
+
+def extract_data_from_mysql(database_name, table_name, watermark=None):
+    """
+    Extract data from MySQL, or an empty DataFrame if the table does not exist. Any
+    other error is raised, so the table is reported as failed and its dump stays pending.
+    """
+    mysql_config = mysql_config_for(database_name)
+
     try:
-        conn = mysql.connector.connect(**mysql_config)
-        query = f'SELECT * FROM {table_name}'
-        df = pd.read_sql(query, conn)
-        conn.close()
-        return df
+        query, params = table_query(table_name, watermark)
+        with mysql_connection(mysql_config) as conn:
+            return pd.read_sql(query, conn, params=params)
+
+    except (mysql.connector.Error, pd.errors.DatabaseError) as err:
+        if not is_missing_table_error(err):
+            raise
+        print(f"Table {table_name} does not exist in MySQL. Skipping this table.")
+        return pd.DataFrame()  # Return an empty DataFrame
+
+
+def extract_data_from_mysql_chunks(database_name, table_name, chunk_size=extract_chunk_size, watermark=None):
+    """
+    Streams a table from MySQL in DataFrames of at most chunk_size rows. Yields nothing
+    if the table does not exist; any other error, before or after the first chunk, is
+    raised so the table is reported as failed and a partially read table is never merged.
+    """
+    yielded = False
+    query, params = table_query(table_name, watermark)
+    try:
+        for df in iter_query_chunks(mysql_config_for(database_name), query, chunk_size, params):
+            yielded = True
+            yield df
 
     except mysql.connector.Error as err:
-        if err.errno == errorcode.ER_NO_SUCH_TABLE:
-            print(f"Table {table_name} does not exist in MySQL. Skipping this table.")
-            return pd.DataFrame()  # Return an empty DataFrame
-        else:
-            print(f"Error: {err}")
-            return pd.DataFrame()  # Return an empty DataFrame for other errors
+        if yielded or not is_missing_table_error(err):
+            raise
+        print(f"Table {table_name} does not exist in MySQL. Skipping this table.")
+
+
+def extract_data(database_name, table_name, watermark=None):
+    """Reads a table, or its rows after the watermark, from the configured sync_source."""
+    if sync_source == 'parquet':
+        return read_table_parquet(database_name, table_name, watermark=watermark)
+    return extract_data_from_mysql(database_name, table_name, watermark)
+
+
+def extract_data_chunks(database_name, table_name, chunk_size=extract_chunk_size, watermark=None):
+    """Streams a table, or its rows after the watermark, from the configured sync_source in chunks."""
+    if sync_source == 'parquet':
+        return iter_table_parquet_chunks(database_name, table_name, chunk_size, watermark=watermark)
+    return extract_data_from_mysql_chunks(database_name, table_name, chunk_size, watermark)
+
+
+def extract_record_batches(database_name, table_name, chunk_size=extract_chunk_size, watermark=None):
+    """Streams a table, or its rows after the watermark, from the configured sync_source as Arrow record batches."""
+    if sync_source == 'parquet':
+        return iter_table_parquet_batches(database_name, table_name, chunk_size, watermark=watermark)
+    query, params = table_query(table_name, watermark)
+    return iter_query_record_batches(mysql_config_for(database_name), query, chunk_size, params)
 
 
 def generate_bq_schema(df):
@@ -73,29 +224,21 @@ def map_pandas_dtypes(schema):
     return pandas_dtypes
 
 
-def encrypt_data(data, key):
-    iv = os.urandom(16)
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
-    padder = padding.PKCS7(algorithms.AES.block_size).padder()
-    padded_data = padder.update(data.encode()) + padder.finalize()
-    encryptor = cipher.encryptor()
-    encrypted_data = encryptor.update(padded_data) + encryptor.finalize()
-    return base64.b64encode(iv + encrypted_data).decode()
+def infer_table_schema(database_name, table_name):
+    """BigQuery schema of a table from the sync_source's column metadata, or None if unknown."""
+    if sync_source == 'parquet':
+        return parquet_table_schema(database_name, table_name, SENSITIVE_COLUMNS)
+    return mysql_table_schema(mysql_config_for(database_name), table_name, SENSITIVE_COLUMNS)
+
 
+def target_table_schema(client, dataset_id, table_name):
+    """Schema of the BigQuery table, or None if it does not exist yet (from the run's metadata cache)."""
+    return table_metadata(client).schema(dataset_id, table_name)
 
-def encrypt_sensitive_columns(df, key, sensitive_columns):
-    for col in sensitive_columns:
-        if col in df.columns:
-            df[col] = df[col].apply(lambda x: encrypt_data(x, key) if pd.notnull(x) else x)
-    return df
 
 def check_table_exists(client, dataset_id, table_name):
-    table_ref = client.dataset(dataset_id).table(table_name)
-    try:
-        client.get_table(table_ref)
-        return True
-    except Exception as e:
-        return False
+    """Whether the BigQuery table exists, from the run's metadata cache."""
+    return table_metadata(client).exists(dataset_id, table_name)
 
 
 def table_list_to_merge(table_csv, output_csv):
@@ -115,108 +258,508 @@ def table_list_to_merge(table_csv, output_csv):
     df = pd.read_csv(table_csv)
 
     # Filter rows where the filename is in the extracted list
-    pattern = '|'.join(filenames_to_match)
-    filtered_df = df[df['databasename'].str.contains(pattern, na=False, case=False)]
+    # (an empty pattern would match every table, e.g. when no clinic published a new dump)
+    if filenames_to_match:
+        pattern = '|'.join(filenames_to_match)
+        filtered_df = df[df['databasename'].str.contains(pattern, na=False, case=False)]
+    else:
+        filtered_df = df.iloc[0:0]
 
     # Save the filtered results to the output CSV file
     filtered_df.to_csv(output_csv, index=False)
 
 
-def merge_data_in_bigquery(client, dataset_id, tablename, tablename_temp, common_columns, columns_entries, df):
+def merge_query(dataset_id, tablename, tablename_temp, common_columns, columns):
+    """
+    MERGE of the staged rows into the target on id: matched rows are updated, others inserted.
+    """
+    columns_temp = [f"source.{col}" for col in common_columns]
+    columns_insert = [f"source.{col}" for col in columns if col not in common_columns]
+    return f"""
+            MERGE INTO `{dataset_id}.{tablename}` AS target
+            USING `{dataset_id}.{tablename_temp}` AS source
+            ON target.id = source.id
+            WHEN MATCHED THEN
+            UPDATE SET {', '.join([f"target.{col} = source.{col}" for col in common_columns])}
+            WHEN NOT MATCHED THEN
+            INSERT ({', '.join(common_columns + [col for col in columns if col not in common_columns])})
+            VALUES ({', '.join(columns_temp + columns_insert)});
+        """
+
+
+def replace_rows_statements(dataset_id, tablename, tablename_temp, columns, watermark_column=None):
+    """
+    DELETE and INSERT replacing the rows of a table without an id with those of the
+    temp table: all of them, or with a watermark_column those from the lowest staged
+    value on, so rows read again at the watermark are not appended twice. Columns are
+    named, so the table keeps its schema and any columns that only exist in BigQuery.
+    """
+    target = f"`{dataset_id}.{tablename}`"
+    source = f"`{dataset_id}.{tablename_temp}`"
+    condition = "true" if watermark_column is None else \
+        f"`{watermark_column}` >= (SELECT MIN(`{watermark_column}`) FROM {source})"
+    column_list = ', '.join(f"`{column}`" for column in columns)
+    return [f"DELETE FROM {target} WHERE {condition};",
+            f"INSERT INTO {target} ({column_list}) SELECT {column_list} FROM {source};"]
+
+
+def merge_data_in_bigquery(client, dataset_id, tablename, tablename_temp, common_columns, columns_entries, df,
+                           watermark_column=None):
+    """
+    Merges the staged `tablename_temp` table into `tablename`. `df` only needs the
+    columns and dtypes of the staged data (e.g. its first chunk), not all rows.
+    Tables without an id have their rows replaced (see replace_rows_statements()), in one
+    transaction with atomic_swap set. With a watermark_column the temp table only holds
+    the rows from the watermark on, and only the rows from its lowest value on are replaced.
+    """
     table_ref = client.dataset(dataset_id).table(tablename)
     if not check_table_exists(client, dataset_id, tablename):
         print(f"Table {tablename} does not exist. Creating and inserting data.")
-        schema = generate_bq_schema(df)
-        job_config = bigquery.LoadJobConfig(schema=schema)
-        job = client.load_table_from_dataframe(df, table_ref, job_config=job_config)
+        job = client.copy_table(client.dataset(dataset_id).table(tablename_temp), table_ref)
         job.result()
-        print(f"Created table {tablename} and inserted {job.output_rows} rows.")
+        table_metadata(client).added(dataset_id, tablename)
+        print(f"Created table {tablename} from {tablename_temp}.")
         return
 
-    table = client.get_table(table_ref)
-    target_columns = {schema_field.name for schema_field in table.schema}
+    target_columns = {schema_field.name for schema_field in target_table_schema(client, dataset_id, tablename)}
 
     new_columns = [col for col in df.columns if col not in target_columns]
     if new_columns:
+        table = client.get_table(table_ref)
         new_schema_fields = generate_bq_schema(df[new_columns])
         schema_update = list(table.schema)
         for field in new_schema_fields:
             print(f"Adding column '{field.name}' with type '{field.field_type}'")
             schema_update.append(field)
         table.schema = schema_update
-        client.update_table(table, ["schema"])
+        table_metadata(client).update_table(table, ["schema"])
         print(f"Added new columns to {tablename}: {new_columns}")
 
-    columns_temp = [f"source.{col}" for col in common_columns]
-    columns_insert = [f"source.{col}" for col in df.columns if col not in common_columns]
-
     if "id" in columns_entries:
-        merge_query = f"""
-            MERGE INTO `{dataset_id}.{tablename}` AS target
-            USING `{dataset_id}.{tablename_temp}` AS source
-            ON target.id = source.id
-            WHEN MATCHED THEN
-            UPDATE SET {', '.join([f"target.{col} = source.{col}" for col in common_columns])}
-            WHEN NOT MATCHED THEN
-            INSERT ({', '.join(common_columns + [col for col in df.columns if col not in common_columns])})
-            VALUES ({', '.join(columns_temp + columns_insert)});
-        """
-        job = client.query(merge_query)
+        job = client.query(merge_query(dataset_id, tablename, tablename_temp, common_columns, df.columns))
         results = job.result()
         print("Merge operation completed successfully.")
     else:
-        truncate_query = f"DELETE FROM `{dataset_id}.{tablename}` WHERE true"
-        truncate_job = client.query(truncate_query)
-        truncate_results = truncate_job.result()
-        print(f"Truncate operation completed successfully.")
-        insert_query = f"INSERT INTO `{dataset_id}.{tablename}` SELECT * FROM `{dataset_id}.{tablename_temp}`"
-        insert_job = client.query(insert_query)
-        insert_results = insert_job.result()
-        print(f"Insert operation completed successfully.")
+        statements = replace_rows_statements(dataset_id, tablename, tablename_temp, df.columns, watermark_column)
+        if atomic_swap or watermark_column is not None:
+            client.query('\n'.join(["BEGIN TRANSACTION;"] + statements + ["COMMIT TRANSACTION;"])).result()
+        else:
+            for statement in statements:
+                client.query(statement).result()
+        print(f"Replaced the rows of {tablename} with {tablename_temp}.")
 
 
 
-def main():
-    table_list_to_merge(table_csv = 'tablename.csv', output_csv = 'merge_table.csv')
+def merge_statements(client, dataset_id, tablename, tablename_temp, common_columns, columns_entries, df,
+                     watermark_column=None):
+    """
+    The statements merge_data_in_bigquery() would run as separate jobs, as SQL for a
+    merge script: CREATE TABLE ... COPY for a new table, ALTER TABLE for new columns,
+    then the MERGE (or replacement) and the DROP of the temp table.
 
-    tables_list = pd.read_csv(os.path.abspath(os.getcwd()) + '/merge_table.csv')
-    tables_list = tables_list.values.tolist()
+    Returns:
+        list: SQL statements, each ending with ';'.
+    """
+    target = f"`{dataset_id}.{tablename}`"
+    source = f"`{dataset_id}.{tablename_temp}`"
+    if not check_table_exists(client, dataset_id, tablename):
+        return [f"CREATE TABLE {target} COPY {source};", f"DROP TABLE {source};"]
 
-    for x in tables_list:
+    statements = []
+    target_columns = {schema_field.name for schema_field in target_table_schema(client, dataset_id, tablename)}
+    new_columns = [col for col in df.columns if col not in target_columns]
+    if new_columns:
+        for field in generate_bq_schema(df[new_columns]):
+            statements.append(f"ALTER TABLE {target} ADD COLUMN IF NOT EXISTS `{field.name}` "
+                              f"{DDL_TYPES.get(field.field_type, field.field_type)};")
+
+    if "id" in columns_entries:
+        statements.append(merge_query(dataset_id, tablename, tablename_temp, common_columns, df.columns).strip())
+    else:
+        statements.extend(replace_rows_statements(dataset_id, tablename, tablename_temp, df.columns, watermark_column))
+    statements.append(f"DROP TABLE {source};")
+    return statements
+
+
+def merge_script(entries):
+    """
+    One BigQuery script merging several staged tables. Each table runs in its own
+    BEGIN ... EXCEPTION block, so a failing table is recorded and the script goes on
+    with the next one; the script ends by selecting the failed tables and their errors.
+    A table's DML statements run in a transaction, rolled back if one of them fails,
+    so a failed table is left as it was (DDL cannot run inside a transaction).
+    """
+    lines = ["DECLARE failed ARRAY<STRUCT<table_name STRING, error STRING>> DEFAULT [];"]
+    for entry in entries:
+        lines.append("BEGIN")
+        for is_dml, statements in groupby(entry['statements'],
+                                          key=lambda statement: statement.lstrip().upper().startswith(DML_STATEMENTS)):
+            if is_dml:
+                lines.extend(["  BEGIN", "    BEGIN TRANSACTION;"])
+                lines.extend(f"    {statement}" for statement in statements)
+                lines.extend(["    COMMIT TRANSACTION;", "  EXCEPTION WHEN ERROR THEN",
+                              "    ROLLBACK TRANSACTION;", "    RAISE;", "  END;"])
+            else:
+                lines.extend(f"  {statement}" for statement in statements)
+        lines.append("EXCEPTION WHEN ERROR THEN")
+        lines.append(f"  SET failed = ARRAY_CONCAT(failed, [STRUCT('{entry['table']}' AS table_name, "
+                     f"@@error.message AS error)]);")
+        lines.append("END;")
+    lines.append("SELECT table_name, error FROM UNNEST(failed);")
+    return '\n'.join(lines)
+
+
+def script_rejected(client, job):
+    """
+    True if a merge script failed before any of its statements ran: the query was
+    never created, or was rejected as invalid without starting a child job.
+    """
+    if job is None or job.job_id is None:
+        return True
+    if job.state != 'DONE' or (job.error_result or {}).get('reason') not in ('invalid', 'invalidQuery'):
+        return False
+    return not any(True for _ in client.list_jobs(parent_job=job.job_id))
+
+
+def script_merged_tables(client, job, dataset_id, batch):
+    """
+    Tables of a failed merge script that were merged before it failed, read from its
+    child jobs: a table is merged once the DROP of its temp table has succeeded.
+    """
+    dropped = set()
+    for child in client.list_jobs(parent_job=job.job_id):
+        query = getattr(child, 'query', None) or ''
+        if child.state == 'DONE' and child.error_result is None and query.lstrip().upper().startswith('DROP TABLE'):
+            dropped.add(query)
+    return {entry['table'] for entry in batch
+            if any(f"`{dataset_id}.{entry['table']}_temp`" in query for query in dropped)}
+
+
+def run_merge_scripts(client, staged, max_tables=merge_script_max_tables, max_workers=sync_max_workers):
+    """
+    Merges tables staged by sync_table() in batched mode: one script per dataset (or per
+    `max_tables` of its tables) instead of several jobs per table, with datasets merged
+    concurrently. If a script is rejected before it runs, its tables are merged one by
+    one; if it fails while running, the tables it did not merge are reported as failed.
+
+    Parameters:
+        staged (list): {database, table, statements, merge, finalize} dicts returned by sync_table().
+
+    Returns:
+        dict: {database.table: error} of the tables that could not be merged.
+    """
+    batches = []
+    datasets = {}
+    for entry in staged:
+        datasets.setdefault(entry['database'], []).append(entry)
+    for dataset_id, entries in datasets.items():
+        for start in range(0, len(entries), max_tables):
+            batches.append((dataset_id, entries[start:start + max_tables]))
+
+    def merge_batch(dataset_id, batch):
+        failed = {}
+        job = None
         try:
-            df = extract_data_from_mysql(x[0], x[1])
+            job = client.query(merge_script(batch))
+            rows = job.result()
+            failed = {f"{dataset_id}.{row['table_name']}": row['error'] for row in rows}
+            print(f"Merged {len(batch) - len(failed)} of {len(batch)} tables of {dataset_id} in one script.")
+        except Exception as e:
+            if script_rejected(client, job):
+                print(f"Merge script for {dataset_id} was rejected ({e}), merging its {len(batch)} tables one by one")
+                for entry in batch:
+                    try:
+                        entry['merge']()
+                    except Exception as table_error:
+                        failed[f"{dataset_id}.{entry['table']}"] = repr(table_error)
+            else:
+                # Some statements ran: merging the tables again could apply them twice
+                merged = script_merged_tables(client, job, dataset_id, batch)
+                failed = {f"{dataset_id}.{entry['table']}": repr(e) for entry in batch if entry['table'] not in merged}
+                print(f"Merge script for {dataset_id} failed ({e}), {len(merged)} of {len(batch)} tables merged")
+        for entry in batch:
+            # Created or altered by the script
+            table_metadata(client).changed(dataset_id, entry['table'])
+            if f"{dataset_id}.{entry['table']}" not in failed:
+                # A failed table keeps its temp table, replaced by the next run's first load
+                table_metadata(client).deleted(dataset_id, f"{entry['table']}_temp")
+                entry['finalize']()
+        return failed
+
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        for batch_failed in executor.map(lambda batch: merge_batch(*batch), batches):
+            failed.update(batch_failed)
+    return failed
+
+
+def prepare_chunk(df, encryption_key, schema=None, source_schema=None):
+    """
+    Encrypts the sensitive columns of a DataFrame and casts it to the BigQuery schema.
+    The schema is inferred from column metadata (see sync_table()); without one it is
+    generated from the first chunk and later chunks are cast to it.
 
-            if df.empty:
-                print(f"Table {x[0]}.{x[1]}.============================= No data to process")
-                continue  # Skip this table and move to the next iteration
+    Returns:
+        tuple: (DataFrame, schema)
+    """
+    df = encrypt_sensitive_columns(df, encryption_key, SENSITIVE_COLUMNS)
+    if schema is None:
+        schema = generate_bq_schema(df)
+    return apply_schema(df, schema, source_schema), schema
 
-            table_id = f'{x[0]}.{x[1]}'
-            encryption_key = os.urandom(32)
-            sensitive_columns = ['fname', 'lname', 'mname', 'phonenumber', 'email', 'address', 'KinsFirstName', 'KinsLastName', 'KinsPhone', 'KinsAddress']
 
-            df = encrypt_sensitive_columns(df, encryption_key, sensitive_columns)
-            schema = generate_bq_schema(df)
-            pandas_dtypes = map_pandas_dtypes(schema)
+def prepare_arrow_chunk(batch, encryption_key):
+    """
+    Arrow counterpart of prepare_chunk(): encrypts the sensitive columns of a record batch.
+    The column types already come from MySQL, so no cast is needed.
+
+    Returns:
+        tuple: (record batch, schema)
+    """
+    batch = encrypt_arrow_columns(batch, encryption_key, SENSITIVE_COLUMNS)
+    return batch, arrow_bq_schema(batch.schema)
 
-            for column, dtype in pandas_dtypes.items():
-                df[column] = df[column].astype(dtype)
 
-            temp_table_id = f'{table_id}_temp'
-            job_config = bigquery.LoadJobConfig(schema=schema)
-            job = client.load_table_from_dataframe(df, temp_table_id, job_config=job_config)
+def sync_table(database_name, table_name, watermark_column=None, watermarks=None):
+    """
+    Stages one MySQL table in `<table>_temp` and merges it into BigQuery.
+
+    With extract_chunk_size set, the table is streamed from the source and encrypted
+    and loaded into the temp table chunk by chunk, so memory is bounded by the chunk
+    size rather than the table size. With extract_arrow set, chunks are typed Arrow
+    record batches instead of DataFrames. Prints the peak RSS seen for the table.
+    Extraction, transformation (filtering, encryption, casts) and loading run as
+    pipeline stages, so the next chunk is read while the previous one is loading.
+
+    With a watermark_column (an increasing id or updated-at column) and a previous
+    watermark in `watermarks`, only rows with that value or higher are extracted and merged.
+    After a successful merge the highest value seen becomes the table's new watermark
+    in `watermarks`; the caller saves it. Rows deleted in MySQL are not detected.
+
+    With row_hash_change_detection set, rows of tables with an id whose content hash
+    matches the previous run are not staged, so only new or changed rows are merged.
+
+    With batched_merge set, the table is only staged: the merge statements are returned,
+    to be run with the other tables of the dataset by run_merge_scripts(), along with
+    the per-table merge to fall back on and the bookkeeping to do once merged.
+    """
+    start = time.monotonic()
+    client = bigquery_client()
+    table_id = f'{database_name}.{table_name}'
+    temp_table_id = f'{table_id}_temp'
+    encryption_key = run_encryption_key()
+    rss = RSSTracker()
+
+    watermark = None
+    entry = (watermarks or {}).get(table_id)
+    if watermark_column and entry and entry['column'] == watermark_column:
+        if check_table_exists(client, database_name, table_name):
+            watermark = (watermark_column, entry['value'])
+            print(f"{table_id}: extracting rows with {watermark_column} >= {entry['value']}")
+        else:
+            print(f"{table_id}: not in BigQuery, ignoring the watermark and syncing the whole table")
+
+    hash_index = None
+    if row_hash_change_detection:
+        hash_index = RowHashIndex(database_name, table_name)
+        if len(hash_index.previous) and not check_table_exists(client, database_name, table_name):
+            print(f"{table_id}: not in BigQuery, staging every row")
+            hash_index.previous = hash_index.previous.iloc[0:0]
+
+    if extract_arrow:
+        chunks = extract_record_batches(database_name, table_name, watermark=watermark)
+    elif extract_chunk_size:
+        chunks = extract_data_chunks(database_name, table_name, watermark=watermark)
+    else:
+        chunks = [extract_data(database_name, table_name, watermark)]
+
+    # Column types come from the source's metadata, with the types of columns already
+    # in BigQuery kept so the staged table can be merged
+    source_schema = None if extract_arrow else infer_table_schema(database_name, table_name)
+    schema = None
+    if source_schema is not None:
+        schema = reconcile_schema(source_schema, target_table_schema(client, database_name, table_name))
+    columns_df = None
+    rows = 0
+    high = None
+
+    def transform(chunk):
+        # Keeps the rows to stage, then encrypts and casts them
+        nonlocal schema, high, hash_index
+        rss.sample()
+        if len(chunk) == 0:
+            return None
+
+        if watermark_column:
+            chunk_high = chunk_max(chunk, watermark_column)
+            if chunk_high is not None and (high is None or chunk_high > high):
+                high = chunk_high
+
+        if hash_index is not None:
+            columns = chunk.schema.names if extract_arrow else chunk.columns
+            if 'id' in columns:
+                chunk = hash_index.filter(chunk)
+                if len(chunk) == 0:
+                    return None
+            else:
+                # Without an id the table is replaced as a whole, every row is needed
+                hash_index = None
+
+        if extract_arrow:
+            return prepare_arrow_chunk(chunk, encryption_key)
+        chunk, schema = prepare_chunk(chunk, encryption_key, schema, source_schema)
+        return chunk, schema
+
+    def load(prepared):
+        nonlocal columns_df, rows
+        chunk, chunk_schema = prepared
+
+        # The first chunk replaces any temp table left behind by a failed run
+        write_disposition = (bigquery.WriteDisposition.WRITE_TRUNCATE if columns_df is None
+                             else bigquery.WriteDisposition.WRITE_APPEND)
+
+        if extract_arrow:
+            job = load_arrow_table(client, chunk, temp_table_id, chunk_schema, write_disposition)
+            chunk_columns = chunk.schema.empty_table().to_pandas()
+        else:
+            job_config = bigquery.LoadJobConfig(schema=chunk_schema, write_disposition=write_disposition)
+            job = client.load_table_from_dataframe(chunk, temp_table_id, job_config=job_config)
             job.result()
+            chunk_columns = chunk.iloc[0:0]
+        rows += job.output_rows
 
-            print(f'Loaded {job.output_rows} rows into temporary table {temp_table_id}.')
+        if columns_df is None:
+            columns_df = chunk_columns
+        rss.sample()
 
-            common_columns = df.columns.tolist()
-            merge_data_in_bigquery(client, x[0], x[1], f'{x[1]}_temp', common_columns, df.columns, df)
+    run_stages(chunks, [('transform', transform), ('load', load)])
 
-            client.delete_table(temp_table_id)
-            print(f'Deleted temporary table {temp_table_id}.==================== completed')
+    if hash_index is not None:
+        hash_index.print_counts(table_id)
 
-        except Exception as e:
-            print(f"Table {x[0]}.{x[1]} =========================== doesn't exist")
-            continue  # Continue to the next table if there's an error
+    if columns_df is None:
+        if hash_index is not None:
+            hash_index.save()
+        if watermark is not None or (hash_index is not None and hash_index.counts['unchanged']):
+            print(f"Table {table_id}.============================= No new or changed rows since the last sync")
+        else:
+            print(f"Table {table_id}.============================= No data to process")
+        return
+
+    print(f'Loaded {rows} rows into temporary table {temp_table_id}.')
+
+    common_columns = columns_df.columns.tolist()
+    # Only set when the temp table holds the rows from the watermark on, not the whole table
+    merge_watermark = watermark[0] if watermark else None
+
+    def merge():
+        merge_start = time.monotonic()
+        merge_data_in_bigquery(client, database_name, table_name, f'{table_name}_temp', common_columns, columns_df.columns, columns_df,
+                               watermark_column=merge_watermark)
+
+        client.delete_table(temp_table_id)
+        table_metadata(client).deleted(database_name, f'{table_name}_temp')
+        print(f'Deleted temporary table {temp_table_id}.==================== completed')
+        print(f'{table_id}: staged in {merge_start - start:.1f}s, merged in {time.monotonic() - merge_start:.1f}s')
+
+    def finalize():
+        if hash_index is not None:
+            hash_index.save()
+
+        if watermark_column and watermarks is not None and high is not None:
+            with watermarks_lock:
+                watermarks[table_id] = {
+                    'column': watermark_column,
+                    'value': str(high),
+                    'synced_at': datetime.now().isoformat(timespec='seconds'),
+                }
+
+    print(f'{table_id}: peak RSS {rss.peak_mb:.0f} MB (started at {rss.start_mb:.0f} MB)')
+    if batched_merge:
+        statements = merge_statements(client, database_name, table_name, f'{table_name}_temp', common_columns,
+                                      columns_df.columns, columns_df, watermark_column=merge_watermark)
+        return {'database': database_name, 'table': table_name, 'statements': statements,
+                'merge': merge, 'finalize': finalize}
+
+    merge()
+    finalize()
+
+
+def read_table_list(table_csv):
+    """
+    Reads (database, table, watermark column or None) entries from a table list CSV.
+    """
+    tables_list = pd.read_csv(table_csv)
+    if 'watermark_column' not in tables_list.columns:
+        tables_list['watermark_column'] = None
+    tables_list = tables_list[['databasename', 'tablename', 'watermark_column']].values.tolist()
+    return [(x[0], x[1], x[2] if isinstance(x[2], str) and x[2] else None) for x in tables_list]
+
+
+def sync_tables(tables, on_done=None):
+    """
+    Syncs (database, table, watermark column) entries with the table scheduler and
+    prints the run's summary and metrics.
+
+    Parameters:
+        tables (list): Entries as returned by read_table_list().
+        on_done (callable): Called with each table's final result; as tables finish,
+            or once the merge scripts ran with batched_merge set.
+
+    Returns:
+        list: The run_table_syncs() result of every table.
+    """
+    watermarks = load_watermarks()
+    tables = [(database, table, watermark_column, watermarks) for database, table, watermark_column in tables]
+
+    def table_done(result):
+        # A failed table keeps its previous watermark, the others are persisted as they finish
+        if result['status'] == 'ok':
+            save_watermarks(watermarks)
+        else:
+            print(f"Table {result['database']}.{result['table']} =========================== failed, continuing")
+        if on_done is not None and not batched_merge:
+            on_done(result)
+
+    start = time.monotonic()
+    results = run_table_syncs(tables, sync_table, on_done=table_done)
+
+    if batched_merge:
+        staged = [result['value'] for result in results if result['status'] == 'ok' and result['value']]
+        failed = run_merge_scripts(bigquery_client(), staged)
+        for result in results:
+            if f"{result['database']}.{result['table']}" in failed:
+                result['status'] = 'failed'
+                result['error'] = failed[f"{result['database']}.{result['table']}"]
+        save_watermarks(watermarks)
+        if on_done is not None:
+            for result in results:
+                on_done(result)
+
+    print_sync_summary(results, time.monotonic() - start)
+    print_stage_metrics(time.monotonic() - start)
+    print_token_cache_stats()
+    print_pool_counts()
+    close_idle_connections()
+    save_schema_cache()
+    return results
+
+
+def confirm_synced_dumps(results, database_csv):
+    """
+    Moves the pending manifest entries of clinics whose tables all synced into the
+    dumps manifest; a clinic with a failed table is downloaded and synced again next run.
+    """
+    failed = {result['database'] for result in results if result['status'] != 'ok'}
+    synced = {result['database'] for result in results} - failed
+    databases = pd.read_csv(database_csv)
+    confirm_manifest_entries(databases.loc[databases['databasename'].isin(synced), 'filename'])
+
+
+def main():
+    table_list_to_merge(table_csv = 'tablename.csv', output_csv = 'merge_table.csv')
+    results = sync_tables(read_table_list(os.path.abspath(os.getcwd()) + '/merge_table.csv'))
+    confirm_synced_dumps(results, os.path.abspath(os.getcwd()) + '/databasename.csv')
 
 
 # Run the sync function
@@ -1,7 +1,29 @@
 import mysql.connector
 import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import config_heliumplus
 import pandas as pd
+from download_heliumplus_dumps import discard_pending_entries
+from heliumplus_dump_parser import iter_sql_statements, statement_table
+from heliumplus_mysql_pool import close_idle_connections, mysql_connection, pool_counts, print_pool_counts
+
+# Load dumps in large transactions with unique/foreign key checks off instead of one commit per statement
+import_bulk_mode = getattr(config_heliumplus, 'import_bulk_mode', True)
+
+# Number of statements per transaction in bulk mode
+import_batch_size = getattr(config_heliumplus, 'import_batch_size', 500)
+
+# Read buffer for dump files
+dump_read_buffer = 1024 * 1024
+
+# Number of clinic databases imported at the same time
+import_max_workers = getattr(config_heliumplus, 'import_max_workers', min(4, os.cpu_count() or 1))
+
+# Dumps larger than import_table_split_mb are split by table and loaded over import_table_workers connections
+import_table_workers = getattr(config_heliumplus, 'import_table_workers', 4)
+import_table_split_mb = getattr(config_heliumplus, 'import_table_split_mb', 512)
 
 
 def database_list_to_import(database_csv, output_csv):
@@ -32,52 +54,308 @@ def database_list_to_import(database_csv, output_csv):
     print(f"Filtered results saved to {output_csv}")
 
 
-def import_mysql_dump(host, user, password, database, port, dump_file_path):
+def open_dump_file(dump_file_path):
+    """
+    Opens a dump file for reading as text with a large read buffer.
+    """
+    return open(dump_file_path, 'r', buffering=dump_read_buffer)
+
+
+def load_statements_bulk(conn, cursor, statements, batch_size=import_batch_size):
+    """
+    Executes dump statements in large transactions with unique and foreign key
+    checks disabled, committing every `batch_size` statements.
+
+    Returns:
+        tuple: (number of statements executed, number of failed statements)
+    """
+    executed = 0
+    errors = 0
+    conn.autocommit = False
+    cursor.execute("SET SESSION unique_checks = 0")
+    cursor.execute("SET SESSION foreign_key_checks = 0")
     try:
-        # Connect to MySQL server
-        conn = mysql.connector.connect(
-            host=host,
-            user=user,
-            password=password,
-            port=port
-        )
-        
+        for sql_command in statements:
+            try:
+                cursor.execute(sql_command)
+            except mysql.connector.Error as err:
+                errors += 1
+                print(f"Error: {err}")
+                print(f"Command: {sql_command[:500]}")
+            executed += 1
+            if executed % batch_size == 0:
+                conn.commit()
+        conn.commit()
+    finally:
+        cursor.execute("SET SESSION unique_checks = 1")
+        cursor.execute("SET SESSION foreign_key_checks = 1")
+    return executed, errors
+
+
+def spool_statement(f, statement):
+    data = statement.encode('utf-8')
+    f.write(b'%d\n' % len(data))
+    f.write(data)
+
+
+def iter_spooled_statements(path):
+    """
+    Yields the statements written to a spool file by spool_statement.
+    """
+    with open(path, 'rb', buffering=dump_read_buffer) as f:
+        while True:
+            header = f.readline()
+            if not header:
+                return
+            yield f.read(int(header)).decode('utf-8')
+
+
+def split_dump_by_table(file, spool_dir):
+    """
+    Splits a dump into the parts that can be loaded independently.
+
+    Returns:
+        dict: 'preamble' - session statements before the first table, replayed on every connection;
+              'ddl' - DROP/CREATE TABLE statements in dump order;
+              'tables' - {table: spool file path} with each table's LOCK/INSERT/ALTER/UNLOCK statements;
+              'epilogue' - remaining statements (views, triggers, session restore) in dump order.
+    """
+    parts = {'preamble': [], 'ddl': [], 'tables': {}, 'epilogue': []}
+    current_table = None
+    spool = None
+    try:
+        for statement in iter_sql_statements(file):
+            verb, table = statement_table(statement)
+            if verb in ('DROP', 'CREATE'):
+                parts['ddl'].append(statement)
+                continue
+            if verb == 'UNLOCK':
+                table = current_table
+            if table is None:
+                if parts['ddl'] or parts['tables']:
+                    parts['epilogue'].append(statement)
+                else:
+                    parts['preamble'].append(statement)
+                continue
+
+            if table != current_table:
+                if spool is not None:
+                    spool.close()
+                path = parts['tables'].setdefault(table, os.path.join(spool_dir, f"{len(parts['tables'])}.spool"))
+                spool = open(path, 'ab')
+                current_table = table
+            spool_statement(spool, statement)
+    finally:
+        if spool is not None:
+            spool.close()
+    return parts
+
+
+def load_spooled_table(mysql_config, preamble, path, batch_size):
+    """
+    Loads one table's spooled data statements over a pooled connection of the database.
+    """
+    with mysql_connection(mysql_config) as conn:
         cursor = conn.cursor()
-        
-        # # Drop database if exists
-        # cursor.execute(f"DROP DATABASE IF EXISTS {database}")
-        
-        # # Create database
-        # cursor.execute(f"CREATE DATABASE {database}")
-        
-        # Connect to the specific database
-        conn.database = database
-        
-        # Read the dump file line by line
-        with open(dump_file_path, 'r') as file:
-            sql_command = ""
-            for line in file:
-                if line.strip().endswith(';'):
-                    sql_command += line.strip()
-                    try:
-                        cursor.execute(sql_command)
-                        conn.commit()
-                        print(f"Executed: {sql_command}")
-                    except mysql.connector.Error as err:
-                        print(f"Error: {err}")
-                        print(f"Command: {sql_command}")
-                    sql_command = ""
+        try:
+            for statement in preamble:
+                cursor.execute(statement)
+            return load_statements_bulk(conn, cursor, iter_spooled_statements(path), batch_size)
+        finally:
+            cursor.close()
+
+
+def import_mysql_dump_by_table(host, user, password, database, port, dump_file_path,
+                               table_workers=import_table_workers, batch_size=import_batch_size):
+    """
+    Imports a large dump by loading its tables in parallel connections.
+
+    The dump is split into per-table spool files next to it, the DROP/CREATE TABLE
+    statements are run first on one connection, then each table's data is loaded
+    on one of `table_workers` connections (largest tables first), and finally the
+    remaining statements such as views and triggers are run. Table workers reuse
+    the connections of the database's pool rather than opening one per table.
+
+    Returns:
+        dict: Statements executed, failed statements and seconds taken, or None if
+        the connection failed.
+    """
+    start = time.monotonic()
+    spool_parent = os.path.dirname(dump_file_path) if isinstance(dump_file_path, str) else None
+    try:
+        with tempfile.TemporaryDirectory(prefix='.spool-', dir=spool_parent) as spool_dir:
+            with open_dump_file(dump_file_path) as file:
+                parts = split_dump_by_table(file, spool_dir)
+
+            mysql_config = {'host': host, 'user': user, 'password': password, 'port': port, 'database': database}
+            with mysql_connection(mysql_config) as conn:
+                cursor = conn.cursor()
+                try:
+                    executed, errors = load_statements_bulk(conn, cursor, parts['preamble'] + parts['ddl'], batch_size)
+                finally:
+                    cursor.close()
+
+            spools = sorted(parts['tables'].values(), key=os.path.getsize, reverse=True)
+            with ThreadPoolExecutor(max_workers=table_workers) as executor:
+                futures = [executor.submit(load_spooled_table, mysql_config, parts['preamble'], path, batch_size)
+                           for path in spools]
+                for future in futures:
+                    table_executed, table_errors = future.result()
+                    executed += table_executed
+                    errors += table_errors
+
+            with mysql_connection(mysql_config) as conn:
+                cursor = conn.cursor()
+                try:
+                    epilogue_executed, epilogue_errors = load_statements_bulk(conn, cursor, parts['epilogue'], batch_size)
+                finally:
+                    cursor.close()
+            executed += epilogue_executed
+            errors += epilogue_errors
+
+        seconds = time.monotonic() - start
+        print(f"Imported {database}: {executed} statements ({errors} failed) across "
+              f"{len(spools)} tables in {seconds:.1f}s")
+        return {'statements': executed, 'errors': errors, 'seconds': seconds}
+
+    except mysql.connector.Error as err:
+        print(f"Error: {err}")
+
+
+def import_mysql_dump(host, user, password, database, port, dump_file_path,
+                      bulk=import_bulk_mode, batch_size=import_batch_size, table_workers=import_table_workers):
+    """
+    Imports a dump into `database`.
+
+    With bulk=True statements are batched into transactions of `batch_size` with
+    unique/foreign key checks disabled and are not echoed; with bulk=False every
+    statement is committed and printed individually. Bulk imports of dump files
+    larger than import_table_split_mb are loaded table by table over
+    `table_workers` connections.
+
+    Returns:
+        dict: Statements executed, failed statements, seconds taken and MySQL
+        connections opened/reused, or None if the connection failed.
+    """
+    counts = pool_counts()
+    try:
+        result = _import_mysql_dump(host, user, password, database, port, dump_file_path, bulk, batch_size,
+                                    table_workers)
+    finally:
+        close_idle_connections(database)
+    if result is not None:
+        result['connections'] = {name: value - counts[name] for name, value in pool_counts().items()}
+    return result
+
+
+def _import_mysql_dump(host, user, password, database, port, dump_file_path, bulk, batch_size, table_workers):
+    if (bulk and table_workers > 1 and isinstance(dump_file_path, str)
+            and os.path.getsize(dump_file_path) >= import_table_split_mb * 1024 * 1024):
+        return import_mysql_dump_by_table(host, user, password, database, port, dump_file_path,
+                                          table_workers, batch_size)
+
+    try:
+        # Connect to the specific database over a pooled connection
+        mysql_config = {'host': host, 'user': user, 'password': password, 'port': port, 'database': database}
+        with mysql_connection(mysql_config) as conn:
+            cursor = conn.cursor()
+
+            # # Drop database if exists
+            # cursor.execute(f"DROP DATABASE IF EXISTS {database}")
+
+            # # Create database
+            # cursor.execute(f"CREATE DATABASE {database}")
+
+            start = time.monotonic()
+            executed = 0
+            errors = 0
+
+            # Read the dump file statement by statement
+            with open_dump_file(dump_file_path) as file:
+                if bulk:
+                    executed, errors = load_statements_bulk(conn, cursor, iter_sql_statements(file), batch_size)
                 else:
-                    sql_command += line.strip() + " "
-        
-        # Close the cursor and connection
-        cursor.close()
-        conn.close()
+                    for sql_command in iter_sql_statements(file):
+                        try:
+                            cursor.execute(sql_command)
+                            conn.commit()
+                            print(f"Executed: {sql_command}")
+                        except mysql.connector.Error as err:
+                            errors += 1
+                            print(f"Error: {err}")
+                            print(f"Command: {sql_command}")
+                        executed += 1
+
+            seconds = time.monotonic() - start
+            print(f"Imported {database}: {executed} statements ({errors} failed) in {seconds:.1f}s")
+
+            # Close the cursor; the connection goes back to the pool
+            cursor.close()
+
+        return {'statements': executed, 'errors': errors, 'seconds': seconds}
     
     except mysql.connector.Error as err:
         print(f"Error: {err}")
 
 
+def print_import_report(imports, timings, total_seconds):
+    """
+    Prints per-database dump size, duration and statements/sec of an import run.
+    """
+    print(f"{'database':<50} {'MB':>9} {'seconds':>9} {'stmts/s':>9}")
+    for database, dump_file_path in imports:
+        stats = timings.get(database)
+        size_mb = os.path.getsize(dump_file_path) / (1024 * 1024) if os.path.exists(dump_file_path) else 0.0
+        if stats is None:
+            print(f"{database:<50} {size_mb:>9.1f} {'failed':>9}")
+            continue
+        rate = stats['statements'] / stats['seconds'] if stats['seconds'] else 0.0
+        print(f"{database:<50} {size_mb:>9.1f} {stats['seconds']:>9.1f} {rate:>9.0f}")
+    imported = sum(1 for stats in timings.values() if stats is not None)
+    print(f"Imported {imported} databases ({len(timings) - imported} failed) in {total_seconds:.1f}s "
+          f"with {import_max_workers} workers.")
+    # Each import ran in a worker process with its own pool, so add up what they reported
+    connections = [stats['connections'] for stats in timings.values() if stats and 'connections' in stats]
+    if connections:
+        print_pool_counts({name: sum(counts[name] for counts in connections) for name in connections[0]})
+
+
+def run_imports(imports, host, user, password, port, on_done=None):
+    """
+    Imports (database, dump file path) pairs on import_max_workers processes, largest
+    dumps first, and prints the import report.
+
+    Parameters:
+        on_done (callable): Called with (database, stats) as each import completes;
+            stats is None if the import failed.
+
+    Returns:
+        dict: import_mysql_dump() stats by database.
+    """
+    # Start the largest dumps first so a big clinic does not end up running alone at the end
+    imports = sorted(imports, key=lambda item: os.path.getsize(item[1]) if os.path.exists(item[1]) else 0,
+                     reverse=True)
+
+    timings = {}
+    start = time.monotonic()
+    with ProcessPoolExecutor(max_workers=max(1, import_max_workers)) as executor:
+        # Import the MySQL database dumps
+        futures = {executor.submit(import_mysql_dump, host, user, password, database, port, dump_file_path): database
+                   for database, dump_file_path in imports}
+        for future in as_completed(futures):
+            database = futures[future]
+            try:
+                timings[database] = future.result()
+            except Exception as e:
+                print(f"Error importing {database}: {e}")
+                timings[database] = None
+            if on_done is not None:
+                on_done(database, timings[database])
+
+    print_import_report(imports, timings, time.monotonic() - start)
+    return timings
+
+
 # Main function to sync data from MySQL to BigQuery
 def main():
 
@@ -96,15 +374,26 @@ def main():
      
     imported_databases = []  # List to store the names of imported databases
 
+    imports = []
     for x in database_list:
         database = x[1]
         dump_file_path = os.path.join(os.path.abspath(os.getcwd()), 'dumps-sql', f'{x[0]}.sql')
+        imports.append((database, dump_file_path))
+
+    clinics = {x[1]: x[0] for x in database_list}
+    failed_clinics = []
+
+    def on_done(database, stats):
+        # Add the database name to the list after each import succeeds
+        if stats is None:
+            failed_clinics.append(clinics[database])
+        else:
+            imported_databases.append(database)
 
-        # Import the MySQL database dump
-        import_mysql_dump(host, user, password, database, port, dump_file_path)
+    run_imports(imports, host, user, password, port, on_done=on_done)
 
-        # Add the database name to the list after each import completes
-        imported_databases.append(database)
+    # A failed import keeps its dump out of the manifest, so it is downloaded again next run
+    discard_pending_entries(failed_clinics)
 
     # Print all imported databases after the loop is complete
     for db in imported_databases:
@@ -0,0 +1,20 @@
+import os
+import sys
+import types
+
+# The scripts live at the repository root and are imported as top-level modules
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import config_heliumplus  # noqa: F401
+except ImportError:
+    # config_heliumplus.py holds the credentials and is only decoded in CI; the modules
+    # read these settings at import time, everything else falls back to its default
+    config_heliumplus = types.ModuleType('config_heliumplus')
+    config_heliumplus.sftp_hostname = 'sftp.invalid'
+    config_heliumplus.sftp_username = 'helium'
+    config_heliumplus.sftp_password = 'secret'
+    config_heliumplus.mysql_username = 'root'
+    config_heliumplus.mysql_password = 'root'
+    config_heliumplus.mysql_port = 3306
+    sys.modules['config_heliumplus'] = config_heliumplus
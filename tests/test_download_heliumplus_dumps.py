@@ -0,0 +1,242 @@
+import gzip
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import paramiko
+import pytest
+
+import download_heliumplus_dumps as download
+
+
+class FakeRemoteFile:
+    """Remote file whose reads raise `fail_with` once `fail_after` bytes have been read."""
+
+    def __init__(self, data, fail_after=None, fail_with=socket.timeout):
+        self.data = data
+        self.position = 0
+        self.fail_after = fail_after
+        self.fail_with = fail_with
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def seek(self, offset):
+        self.position = offset
+
+    def prefetch(self, size=None):
+        pass
+
+    def read(self, size):
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise self.fail_with('connection dropped')
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        pass
+
+
+class FakeSFTP:
+    """In-memory SFTP session serving a single remote file."""
+
+    def __init__(self, data, fail_after=None):
+        self.data = data
+        self.fail_after = fail_after
+        self.opened_at = []
+        self.closed = False
+
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat_result((0, 0, 0, 0, 0, 0, len(self.data), 0, 0, 0)))
+
+    def open(self, path, mode):
+        remote_file = FakeRemoteFile(self.data, self.fail_after)
+        original_seek = remote_file.seek
+
+        def seek(offset):
+            self.opened_at.append(offset)
+            original_seek(offset)
+
+        remote_file.seek = seek
+        return remote_file
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSFTPTree:
+    """
+    In-memory SFTP session over {remote path: data}, listing folders like listdir_attr.
+    Reads of the paths in `failing` always drop the connection.
+    """
+
+    def __init__(self, files, failing=()):
+        self.files = files
+        self.failing = set(failing)
+        self.mtime = time.time()
+
+    def listdir_attr(self, folder):
+        prefix = folder.rstrip('/') + '/'
+        entries = {}
+        for path, data in self.files.items():
+            if path.startswith(prefix):
+                name, _, rest = path[len(prefix):].partition('/')
+                attr = paramiko.SFTPAttributes()
+                attr.filename = name
+                attr.st_size = 0 if rest else len(data)
+                attr.st_mtime = self.mtime
+                entries[name] = attr
+        return list(entries.values())
+
+    def open(self, path, mode):
+        return FakeRemoteFile(self.files[path], fail_after=0 if path in self.failing else None)
+
+    def close(self):
+        pass
+
+
+class FakeTransport:
+    def close(self):
+        pass
+
+
+def make_connect(sessions, failures=()):
+    """connect() returning the given sessions in order, raising the given errors first."""
+    failures = list(failures)
+    sessions = list(sessions)
+    calls = []
+
+    def connect():
+        calls.append(1)
+        if failures:
+            raise failures.pop(0)
+        return FakeTransport(), sessions.pop(0)
+
+    connect.calls = calls
+    return connect
+
+
+@pytest.fixture(autouse=True)
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(download, 'sftp_chunk_size', 4)
+    monkeypatch.setattr(download, 'remote_listing_cache', {})
+
+
+def test_download_resumes_after_dropped_connection(tmp_path):
+    data = b'0123456789abcdefghij'
+    dropped = FakeSFTP(data, fail_after=8)
+    healthy = FakeSFTP(data)
+    pool = download.SFTPSessionPool(1, connect=make_connect([dropped, healthy]), retry_delay=0)
+    local_path = str(tmp_path / 'clinic.tar.gz')
+
+    transferred = download.download_with_resume(pool, '/remote/clinic.gz', local_path, retries=2)
+
+    assert open(local_path, 'rb').read() == data
+    assert transferred == len(data)
+    # The second session continues at the bytes already on disk
+    assert dropped.opened_at == [0]
+    assert healthy.opened_at == [8]
+    assert dropped.closed
+
+
+def test_download_gives_up_after_retries(tmp_path):
+    data = b'0123456789'
+    sessions = [FakeSFTP(data, fail_after=0) for _ in range(3)]
+    pool = download.SFTPSessionPool(1, connect=make_connect(sessions), retry_delay=0)
+
+    with pytest.raises(socket.timeout):
+        download.download_with_resume(pool, '/remote/clinic.gz', str(tmp_path / 'clinic.tar.gz'), retries=2)
+
+
+def test_local_disk_error_is_not_retried(tmp_path):
+    connect = make_connect([FakeSFTP(b'0123456789'), FakeSFTP(b'0123456789')])
+    pool = download.SFTPSessionPool(1, connect=connect, retry_delay=0)
+    # A directory in place of the local file fails to open like a read-only or full disk would
+    local_path = tmp_path / 'clinic.tar.gz'
+    local_path.mkdir()
+
+    with pytest.raises(OSError):
+        download.download_with_resume(pool, '/remote/clinic.gz', str(local_path), retries=2)
+    assert len(connect.calls) == 1
+
+
+def test_pool_retries_failed_handshake():
+    session = FakeSFTP(b'')
+    connect = make_connect([session], failures=[paramiko.SSHException('handshake failed')])
+    pool = download.SFTPSessionPool(1, connect=connect, retries=2, retry_delay=0)
+
+    assert pool.acquire() is session
+    assert len(connect.calls) == 2
+
+
+def test_pool_gives_up_after_connect_retries():
+    failures = [ConnectionResetError('reset')] * 3
+    pool = download.SFTPSessionPool(1, connect=make_connect([], failures=failures), retries=2, retry_delay=0)
+
+    with pytest.raises(ConnectionResetError):
+        pool.acquire()
+    # The slot is released, so a later acquire does not block
+    assert pool._slots.acquire(blocking=False)
+
+
+def test_parallel_download_continues_past_a_failing_clinic(tmp_path, monkeypatch):
+    remote_dir = '/home/helium/heliumplus_weekly'
+    clinics = ['Clinic_A', 'Clinic_B', 'Clinic_C', 'Clinic_D', 'Skipped_Clinic']
+    files = {f'{remote_dir}/{clinic}/{clinic.lower()}.sql.gz': clinic.encode() * 5 for clinic in clinics}
+    failing = {f'{remote_dir}/Clinic_B/clinic_b.sql.gz'}
+    monkeypatch.setenv('PWD', str(tmp_path))
+    (tmp_path / 'dumps-gz').mkdir()
+    reports = []
+
+    def connect():
+        return FakeTransport(), FakeSFTPTree(files, failing)
+
+    with pytest.raises(RuntimeError, match='Clinic_B'):
+        download.heliumplus_dumps_download_parallel(
+            max_workers=3, connect=connect, manifest_path=str(tmp_path / 'manifest.json'),
+            pending_path=str(tmp_path / 'pending.json'), include=lambda folder: folder != 'Skipped_Clinic',
+            on_done=reports.append)
+
+    statuses = {report['clinic']: report['status'] for report in reports}
+    assert statuses == {'Clinic_A': 'downloaded', 'Clinic_B': 'failed', 'Clinic_C': 'downloaded',
+                        'Clinic_D': 'downloaded'}
+    for clinic in ('Clinic_A', 'Clinic_C', 'Clinic_D'):
+        assert (tmp_path / 'dumps-gz' / f'{clinic}.tar.gz').read_bytes() == clinic.encode() * 5
+    # Only the downloaded dumps wait in the pending manifest for their import and sync
+    assert set(download.load_manifest(str(tmp_path / 'pending.json'))) == {'Clinic_A', 'Clinic_C', 'Clinic_D'}
+
+
+def test_unzip_workers_stay_within_memory_limit(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PWD', str(tmp_path))
+    (tmp_path / 'dumps-gz').mkdir()
+    (tmp_path / 'dumps-sql').mkdir()
+    for i in range(40):
+        with gzip.open(tmp_path / 'dumps-gz' / f'clinic_{i}.tar.gz', 'wb') as f:
+            f.write(b'SELECT 1;\n')
+    pools = []
+    chunk_sizes = set()
+
+    def pool(max_workers):
+        pools.append(max_workers)
+        return ThreadPoolExecutor(max_workers=max_workers)
+
+    def decompress(input_file, output_file, chunk_size):
+        chunk_sizes.add(chunk_size)
+        return original_decompress(input_file, output_file, chunk_size)
+
+    original_decompress = download.decompress_dump
+    monkeypatch.setattr(download, 'ProcessPoolExecutor', pool)
+    monkeypatch.setattr(download, 'decompress_dump', decompress)
+
+    assert download.unzip_dumps(max_workers=32, memory_limit_mb=1) == {}
+
+    # 1 MB holds 16 minimum chunks, so only 16 of the 32 workers are started
+    assert pools == [16]
+    assert chunk_sizes == {64 * 1024}
+    assert len(os.listdir(tmp_path / 'dumps-sql')) == 40
@@ -0,0 +1,55 @@
+import gzip
+
+import heliumplus_driver as driver
+from heliumplus_checkpoints import CheckpointStore
+
+
+def test_failed_clinic_does_not_block_the_others(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('PWD', str(tmp_path))
+    (tmp_path / 'dumps-gz').mkdir()
+    (tmp_path / 'dumps-sql').mkdir()
+    monkeypatch.setattr(driver, 'stream_decompress', False)
+    monkeypatch.setattr(driver, 'database_imported', lambda database: False)
+    monkeypatch.setattr(driver, 'confirm_manifest_entries', lambda clinics: None)
+
+    def download(include, on_done, raise_on_failure=True, **kwargs):
+        # Good_Clinic downloads, Bad_Clinic fails; the failure is only reported
+        assert not raise_on_failure
+        assert include('Good_Clinic') and include('Bad_Clinic')
+        with gzip.open(tmp_path / 'dumps-gz' / 'Good_Clinic.tar.gz', 'wb') as f:
+            f.write(b'CREATE TABLE patients (id int);\n')
+        on_done({'clinic': 'Good_Clinic', 'file': 'good.sql.gz', 'bytes': 10, 'seconds': 0.1, 'status': 'downloaded'})
+        on_done({'clinic': 'Bad_Clinic', 'file': None, 'bytes': 0, 'seconds': 0.0, 'status': 'failed'})
+        return []
+
+    imported = []
+
+    def run_imports(imports, host, user, password, port, on_done=None):
+        for database, path in imports:
+            imported.append((database, open(path).read()))
+            on_done(database, {'statements': 1, 'errors': 0, 'seconds': 0.1})
+
+    synced = []
+
+    def sync_tables(tables, on_done=None):
+        for database, table, _ in tables:
+            synced.append(f'{database}.{table}')
+            on_done({'database': database, 'table': table, 'status': 'ok', 'seconds': 0.1})
+
+    monkeypatch.setattr(driver, 'heliumplus_dumps_download_parallel', download)
+    monkeypatch.setattr(driver, 'run_imports', run_imports)
+    monkeypatch.setattr(driver, 'sync_tables', sync_tables)
+
+    store = CheckpointStore(str(tmp_path / 'checkpoints.json'), 'run-1')
+    clinics = {'good_clinic': 'src_good', 'bad_clinic': 'src_bad'}
+    tables = [('src_good', 'patients', None), ('src_bad', 'patients', None)]
+    complete = driver.PipelineDriver(store, clinics, tables).run()
+
+    assert not complete
+    assert imported == [('src_good', 'CREATE TABLE patients (id int);\n')]
+    assert synced == ['src_good.patients']
+    assert store.status('download', 'good_clinic') == 'done'
+    assert store.status('download', 'bad_clinic') == 'failed'
+    assert store.status('sync', 'src_good.patients') == 'done'
+    assert store.status('sync', 'src_bad.patients') == 'pending'
@@ -0,0 +1,33 @@
+import os
+
+import pytest
+
+import heliumplus_encryption as encryption
+
+
+@pytest.fixture(autouse=True)
+def empty_token_cache(monkeypatch):
+    monkeypatch.setattr(encryption, '_token_cache', encryption.OrderedDict())
+
+
+def test_token_cache_is_capped_across_columns():
+    key = os.urandom(64)
+    fname = encryption.tokenize_values(['ada', 'bob', 'ada'], key, 'fname', cache_size=3)
+    kins = encryption.tokenize_values(['ada', 'cy'], key, 'KinsFirstName', cache_size=3)
+
+    assert len(encryption._token_cache) == 3
+    # The least recently used token was dropped, the others are still cached
+    assert (key, 'fname', 'ada') not in encryption._token_cache
+    assert (key, 'fname', 'bob') in encryption._token_cache
+    # Columns get different tokens for the same value, a cached token equals a fresh one
+    assert fname[0] == fname[2] != kins[0]
+    assert encryption.tokenize_values(['bob'], key, 'fname', cache_size=0) == [fname[1]]
+    assert encryption.detokenize(kins[1], key, 'KinsFirstName') == 'cy'
+
+
+def test_tokenize_counts_repeated_values_as_hits():
+    key = os.urandom(64)
+    tokens, hits = encryption._tokenize(['a', 'a', 'b'], key, 'email', cache_size=10)
+    assert hits == 1
+    tokens, hits = encryption._tokenize(['a', 'b', 'c'], key, 'email', cache_size=10)
+    assert hits == 2
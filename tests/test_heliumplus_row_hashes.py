@@ -0,0 +1,35 @@
+import datetime
+
+import pandas as pd
+import pyarrow as pa
+
+from heliumplus_row_hashes import RowHashIndex, row_hashes
+
+
+def test_row_hash_does_not_depend_on_the_chunk_dtypes():
+    # An integer column with a NULL is read as float64, without one as int64
+    with_null = pd.DataFrame.from_records([(1, 5, 'a'), (2, None, None)], columns=['id', 'count', 'name'])
+    without_null = pd.DataFrame.from_records([(1, 5, 'a'), (3, 7, 'b')], columns=['id', 'count', 'name'])
+    assert with_null['count'].dtype != without_null['count'].dtype
+
+    assert row_hashes(with_null)[0] == row_hashes(without_null)[0]
+    assert row_hashes(with_null)[1] != row_hashes(pd.DataFrame({'id': [2], 'count': [0], 'name': ['']}))[0]
+
+
+def test_row_hash_of_record_batch_matches_dataframe():
+    batch = pa.RecordBatch.from_pydict({'id': [1, 2], 'count': [5, None],
+                                        'at': [datetime.datetime(2024, 1, 1), None]})
+    frame = pd.DataFrame.from_records([(1, 5, datetime.datetime(2024, 1, 1))], columns=['id', 'count', 'at'])
+    assert row_hashes(batch)[0] == row_hashes(frame)[0]
+
+
+def test_unchanged_row_in_chunk_with_other_dtypes_is_not_staged(tmp_path):
+    first = RowHashIndex('src_db', 'patients', folder=str(tmp_path))
+    first.filter(pd.DataFrame.from_records([(1, 5), (2, None)], columns=['id', 'count']))
+    first.save()
+
+    second = RowHashIndex('src_db', 'patients', folder=str(tmp_path))
+    staged = second.filter(pd.DataFrame.from_records([(1, 5), (2, 6)], columns=['id', 'count']))
+
+    assert staged['id'].tolist() == [2]
+    assert second.counts == {'new': 0, 'changed': 1, 'unchanged': 1}